@@ -7,6 +7,11 @@ def bootstrap():
     monkey.patch_all()
     oainit()
 
+    # psycopg2 is a C extension and is not covered by monkey patching. _dao
+    # binds the global context on import, so it has to come after oainit()
+    from ._dao import patch_psycopg2
+    patch_psycopg2()
+
 bootstrap()
 
 # Hoist symbols from submodules
@@ -1,11 +1,17 @@
 __all__ = [
     'OADao',
-    'OADbTransaction'
+    'OADbPool',
+    'OADbTransaction',
+    'patch_psycopg2'
 ]
 
 import binascii
+import collections
+import gevent.lock
+import hashlib
 import os
 import psycopg2
+import re
 import psycopg2.extras
 import psycopg2.extensions
 
@@ -13,10 +19,91 @@ from   textwrap    import dedent as td
 
 from   ._env       import oactx, oalog
 
-from   openarc.exception import OAGraphStorageError
+from   openarc.exception import OAError, OAGraphStorageError
+
+## Cooperative I/O
+
+def gevent_wait_callback(conn, timeout=None):
+    """Wait callback that yields to the gevent hub instead of blocking the
+    process while psycopg2 waits on the database socket"""
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+def patch_psycopg2():
+    """Make psycopg2 cooperative under gevent. Must be called before any
+    connection is opened."""
+    psycopg2.extensions.set_wait_callback(gevent_wait_callback)
 
 ## Exportable classes
 
+class OADbConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that tracks the statements prepared on it and
+    counts round trips to the server"""
+    def __init__(self, *args, **kwargs):
+        super(OADbConnection, self).__init__(*args, **kwargs)
+
+        # Prepared statement name -> number of parameters, in LRU order
+        self.prepared = collections.OrderedDict()
+
+        # Pool schema generation the prepared statements were built against;
+        # None if it isn't known which statements exist on the server
+        self.schema_generation = 0
+
+        # Statements sent to the server over the life of this connection
+        self.roundtrips = 0
+
+        # Schema the connection's search_path is set to, if known
+        self.search_path = None
+
+        # Pool this connection belongs to
+        self.pool = None
+
+        self.cursor_factory = OADbCursor
+
+    def commit(self):
+        if self.status != psycopg2.extensions.STATUS_READY:
+            self.count_roundtrip()
+        super(OADbConnection, self).commit()
+
+    def rollback(self):
+        if self.status != psycopg2.extensions.STATUS_READY:
+            self.count_roundtrip()
+            # SET is transactional, so the search_path may have reverted
+            self.search_path = None
+        super(OADbConnection, self).rollback()
+
+    def count_roundtrip(self, execute=False):
+        """Account for a statement sent to the server. Executing outside
+        autocommit mode on an idle connection costs an implicit BEGIN too."""
+        if execute and not self.autocommit and self.status == psycopg2.extensions.STATUS_READY:
+            self.roundtrips += 1
+            if self.pool:
+                self.pool.roundtrips += 1
+        self.roundtrips += 1
+        if self.pool:
+            self.pool.roundtrips += 1
+
+class OADbCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements it sends"""
+    def execute(self, query, vars=None):
+        self.connection.count_roundtrip(execute=True)
+        return super(OADbCursor, self).execute(query, vars)
+
+class OADbDictCursor(psycopg2.extras.RealDictCursor):
+    """RealDictCursor that counts the statements it sends"""
+    def execute(self, query, vars=None):
+        self.connection.count_roundtrip(execute=True)
+        return super(OADbDictCursor, self).execute(query, vars)
+
 class OADao(object):
     """Wrapper around psycopg2 with additional functionality
     for logging, connection management and sql execution"""
@@ -24,11 +111,11 @@ class OADao(object):
         """Schema refers to the api entity we're referring
         to: auth, trading etc"""
         self.cdict   = cdict
-        self.dbconn  = oactx.db_conn
         self.schema  = schema
         self.trans_depth  = 1
 
         self._cursor = None
+        self._dbconn = None
         self._trans_commit_hold = trans_commit_hold
         self.__enter__()
 
@@ -39,51 +126,82 @@ class OADao(object):
         return self                                  #
                                                      #
     def __exit__(self, exc, value, traceback):       #
-        if not self._trans_commit_hold:              #
-            self.cur_finalize(exc)                   #
+        self.cur_finalize(exc)                       #
     ##################################################
 
     def commit(self):
         """Proxy method for committing dbconnection actions"""
-        self.dbconn.commit()
+        if self._dbconn:
+            self._dbconn.commit()
 
     def rollback(self):
         """Proxy method for rolling back any existing action"""
-        self.dbconn.rollback()
+        if self._dbconn:
+            self._dbconn.rollback()
+
+    @property
+    def dbconn(self):
+        """Connection checked out of the global pool. It is held until the
+        dao finalizes its work, and returned to the pool afterwards"""
+        if self._dbconn is None:
+            self._dbconn = oactx.db_pool.getconn()
+            self._dbconn.autocommit = not self._trans_commit_hold
+        return self._dbconn
+
+    def release(self):
+        """Return connection to the global pool"""
+        if self._dbconn is not None:
+            oactx.db_pool.putconn(self._dbconn)
+            self._dbconn = None
+        self._cursor = None
 
     @property
     def cur(self):
         if not self._cursor:
             if self.cdict:
-                self._cursor = self.dbconn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+                self._cursor = self.dbconn.cursor(cursor_factory=OADbDictCursor)
             else:
                 self._cursor = self.dbconn.cursor()
-            self._cursor.execute("SET search_path TO %s", [self.schema])
         return self._cursor
 
+    def _scope(self):
+        """SET statement pointing the connection's search_path at the dao's
+        schema, or an empty string if it already does. Callers send it ahead
+        of their own statement, so scoping costs no extra round trip."""
+        conn = self.dbconn
+        if conn.search_path == self.schema:
+            return str()
+        conn.search_path = self.schema
+        return self.cur.mogrify("SET search_path TO %s;\n", [self.schema]).decode('utf-8')
+
     def cur_finalize(self, exc):
-        if exc:
-            self.rollback()
-        else:
-            self.commit()
-        self._cursor = None
+        try:
+            if exc:
+                self.rollback()
+            else:
+                self.commit()
+        finally:
+            self.release()
 
     @property
     def description(self):
         return self.cur.description
 
-    def execute(self, query, params=[], savepoint=False, cdict=True, extcur=None):
+    def execute(self, query, params=[], savepoint=False, cdict=True, extcur=None, prepare=False):
         results = None
 
         cur = self.cur
         if cdict != self.cdict:
-            cur = self.dbconn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute("SET search_path TO %s", [self.schema])
+            cur = self.dbconn.cursor(cursor_factory=OADbDictCursor)
         if type(extcur)==list:
             while len(extcur)>0:
                 extcur.pop()
             extcur.append(cur)
 
+        # Statements outside a held transaction are autocommitted, so there is
+        # nothing for a savepoint to protect
+        savepoint = savepoint and self._trans_commit_hold
+
         if savepoint:
             savepoint_name = 'sp_'+binascii.hexlify(os.urandom(7)).decode('utf-8')
             oalog.debug(f"Initializing savepoint [{savepoint_name}]", f='sql')
@@ -93,8 +211,13 @@ class OADao(object):
 
         try:
             try:
-                cur.execute(query, params)
+                scope = self._scope()
+                if prepare and oactx.db_pool.prepare and self._preparable(query, params):
+                    self._execute_prepared(cur, scope, query, params)
+                else:
+                    cur.execute(scope+query, params)
             except Exception as e:
+                self.dbconn.search_path = None
                 raise OAGraphStorageError(str(e), e)
             try:
                 results = cur.fetchall()
@@ -106,14 +229,144 @@ class OADao(object):
                 cur.execute("ROLLBACK TO SAVEPOINT %s" % savepoint_name)
 
             if not self._trans_commit_hold:
-                self.rollback()
+                self.cur_finalize(True)
             raise
         else:
             if not self._trans_commit_hold:
-                self.commit()
+                self.cur_finalize(None)
 
         return results
 
+    def stream(self, query, params=[], itersize=2000):
+        """Generator over the results of query in chunks of itersize rows,
+        fetched lazily through a server side (named) cursor. Server side
+        cursors only live inside a transaction, so the dao must be held."""
+        if not self._trans_commit_hold:
+            raise OAError("Cannot stream results outside a held transaction")
+
+        # Server side cursors take a single statement
+        scope = self._scope()
+        if scope:
+            self.cur.execute(scope)
+
+        cur_name = 'oa_'+binascii.hexlify(os.urandom(7)).decode('utf-8')
+        cur = self.dbconn.cursor(name=cur_name, cursor_factory=OADbDictCursor)
+
+        oalog.debug(f"{td(cur.mogrify(query, params).decode('utf-8'))}", f='sql')
+
+        try:
+            try:
+                cur.execute(query, params)
+            except Exception as e:
+                raise OAGraphStorageError(str(e), e)
+
+            while True:
+                self.dbconn.count_roundtrip()
+                rows = cur.fetchmany(itersize)
+                if len(rows)==0:
+                    break
+                yield rows
+        finally:
+            if not cur.closed and self.dbconn.status == psycopg2.extensions.STATUS_IN_TRANSACTION:
+                self.dbconn.count_roundtrip()
+                try:
+                    cur.close()
+                except psycopg2.Error:
+                    pass
+
+    def execute_values(self, query, argslist, fetch=True):
+        """Execute query for every tuple in argslist in a single round trip,
+        expanding the lone %s in query into a multi-row VALUES list. Returns
+        rows produced by any RETURNING clause if fetch is set."""
+        results = None
+
+        cur = self.cur
+
+        oalog.debug(f"{td(query)} <- [{len(argslist)} rows]", f='sql')
+
+        try:
+            try:
+                results = psycopg2.extras.execute_values(cur, self._scope()+query, argslist,
+                                                         page_size=max(len(argslist), 1),
+                                                         fetch=fetch)
+            except Exception as e:
+                self.dbconn.search_path = None
+                raise OAGraphStorageError(str(e), e)
+        except:
+            if not self._trans_commit_hold:
+                self.cur_finalize(True)
+            raise
+        else:
+            if not self._trans_commit_hold:
+                self.cur_finalize(None)
+
+        return results
+
+    @staticmethod
+    def _preparable(query, params):
+        """Only positional %s parameters are translated into a prepared
+        statement's $n parameters. Named parameters, and quoted literals or
+        $n placeholders whose text the translation could mangle, are run as
+        plain statements."""
+        return isinstance(params, (list, tuple))\
+            and '%(' not in query\
+            and "'" not in query\
+            and '$' not in query
+
+    def _execute_prepared(self, cur, scope, query, params):
+        """Run query as a server side prepared statement. Statements are named
+        after a digest of their (schema qualified) SQL, so each OAG class and
+        searchidx maps onto one statement per connection. Each connection keeps
+        an LRU of the statements prepared on it. Statements are prepared in
+        the same round trip as their first execution, behind scope (see
+        _scope())."""
+        conn = self.dbconn
+        pool = oactx.db_pool
+
+        batch = []
+
+        # DDL may have changed the row type of prepared SELECT *s
+        if conn.schema_generation != pool.schema_generation:
+            if len(conn.prepared)>0 or conn.schema_generation is None:
+                oalog.debug(f"Deallocating {len(conn.prepared)} prepared statements after schema change", f='sql')
+                batch.append("DEALLOCATE ALL")
+                conn.prepared.clear()
+            conn.schema_generation = pool.schema_generation
+
+        stmt_name = 'oa_'+hashlib.sha1(query.encode('utf-8')).hexdigest()[:24]
+        try:
+            conn.prepared.move_to_end(stmt_name)
+        except KeyError:
+            nparams = [0]
+            def pgparam(match):
+                if match.group(1)=='%':
+                    return '%'
+                nparams[0] += 1
+                return '$%d' % nparams[0]
+            pgquery = re.sub(r'%(%|s)', pgparam, query)
+
+            oalog.debug(f"Preparing [{stmt_name}]", f='sql')
+            batch.append("PREPARE %s AS %s" % (stmt_name, pgquery))
+            conn.prepared[stmt_name] = nparams[0]
+
+            while len(conn.prepared)>pool.prepared_max:
+                (evicted, n) = conn.prepared.popitem(last=False)
+                batch.append("DEALLOCATE %s" % evicted)
+
+        if conn.prepared[stmt_name]>0:
+            batch.append(cur.mogrify("EXECUTE %s (%s)" % (stmt_name, ', '.join(['%s']*conn.prepared[stmt_name])), params).decode('utf-8'))
+        else:
+            batch.append("EXECUTE %s" % stmt_name)
+
+        try:
+            cur.execute(scope+';\n'.join(batch))
+        except:
+            # Which statements of a failed batch survived is unknown: start
+            # over on the next prepared execution
+            conn.prepared.clear()
+            conn.schema_generation = None
+            raise
+
     @property
     def isolation(self):
         return self._isolation_level
@@ -126,6 +379,111 @@ class OADao(object):
         READRPT = psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ
         SERIAL  = psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE
 
+class OADbPool(object):
+    """Bounded pool of database connections shared by all greenlets in the
+    process. Connections are opened on demand up to pool_max; greenlets asking
+    for a connection from an exhausted pool wait up to pool_timeout seconds
+    for one to be returned."""
+    def __init__(self, dbinfo):
+        self._dbinfo  = dbinfo
+        self._minconn = dbinfo.get('pool_min', 1)
+        self._maxconn = dbinfo.get('pool_max', 8)
+        self._timeout = dbinfo.get('pool_timeout', 30)
+        if self._minconn > self._maxconn or self._maxconn < 1:
+            raise OAError("Invalid pool size [%s, %s]" % (self._minconn, self._maxconn))
+
+        # Idle connections, most recently returned last
+        self._idle    = []
+
+        # Number of open connections, idle or checked out
+        self._size    = 0
+
+        # One slot per connection that may be checked out
+        self._slots   = gevent.lock.BoundedSemaphore(self._maxconn)
+
+        # Server side prepared statements, and how many to keep per connection
+        self.prepare      = dbinfo.get('prepared_statements', True)
+        self.prepared_max = dbinfo.get('prepared_max', 256)
+
+        # Bumped on DDL so that connections drop stale prepared statements
+        self.schema_generation = 0
+
+        # Statements sent to the server by all connections in the pool
+        self.roundtrips = 0
+
+        for i in range(self._minconn):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        dbinfo = self._dbinfo
+        conn = psycopg2.connect(dbname=dbinfo['dbname'],
+                                user=dbinfo['user'],
+                                password=dbinfo['password'],
+                                host=dbinfo['host'],
+                                port=dbinfo['port'],
+                                connection_factory=OADbConnection)
+        conn.pool = self
+        self._size += 1
+        return conn
+
+    def _discard(self, conn):
+        self._size -= 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """Check out a connection, blocking the current greenlet until one
+        is available or the pool timeout expires"""
+        if not self._slots.acquire(timeout=self._timeout):
+            raise OAGraphStorageError("Timed out waiting for a database connection", None)
+        try:
+            while len(self._idle)>0:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+                self._discard(conn)
+            return self._connect()
+        except:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Return a connection to the pool. Connections with a transaction
+        still in flight are rolled back so that the next borrower starts
+        clean."""
+        try:
+            if conn.closed:
+                self._size -= 1
+                return
+            if conn.status != psycopg2.extensions.STATUS_READY:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+                    return
+            if len(self._idle) >= self._maxconn:
+                self._discard(conn)
+                return
+            self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def schema_changed(self):
+        """Invalidate prepared statements on all connections"""
+        self.schema_generation += 1
+
+    @property
+    def size(self):
+
+        return self._size
+
+    @property
+    def idle(self):
+
+        return len(self._idle)
+
 class OADbTransaction(object):
     """Manipulates the global dbconn object so that all OAGs see the same
     cursor. This is the functional equivalent of a semantic transaction. Captures
@@ -144,6 +502,8 @@ class OADbTransaction(object):
     def __exit__(self, exc, value, traceback):
         self.dao.trans_depth -= 1
         if self.dao.trans_depth == 1:
-            self.dao.cur_finalize(exc)
-            oactx.db_txndao = None
-            self.dao = None
+            try:
+                self.dao.cur_finalize(exc)
+            finally:
+                oactx.db_txndao = None
+                self.dao = None
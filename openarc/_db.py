@@ -1,9 +1,101 @@
+import enum
+import hashlib
+
 from textwrap    import dedent as td
 
 from ._dao             import *
 from ._env             import oaenv, oactx, oalog
+from ._rdf             import RdfWhere
+
+from openarc.exception import OAError, OAGraphRetrieveError, OAGraphStorageError, OAGraphIntegrityError
+
+def dbval(val):
+    """Translate in-memory RDF value to its database representation"""
+    return val.value if isinstance(val, enum.Enum) else val
+
+class DbBatch(object):
+    """Collects rows changed through DbProxy.update() and writes them when
+    the batch exits, with one UPDATE per set of changed columns"""
+    def __init__(self, dbproxy):
+        self._dbproxy = dbproxy
+
+        # Changed columns of staged rows, and their values before the batch,
+        # keyed by primary key
+        self._rows = {}
+        self._originals = {}
+
+        # Broadcast the changes once they are written?
+        self._broadcast = False
+
+    def __enter__(self):
+        if self._dbproxy._batch is not None:
+            raise OAError("Update batch is already active")
+        self._dbproxy._batch = self
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        self._dbproxy._batch = None
+        if exc:
+            self.discard()
+        else:
+            self.flush()
+
+    def discard(self):
+        """Put the values staged rows had before the batch back into the RDF"""
+        rdf = self._dbproxy._oag.rdf
+        for pk, original in self._originals.items():
+            position = rdf.rowposition({self._dbproxy._oag.dbpkname : pk})
+            if position is not None:
+                rdf.patch(position, original)
+        self.clear()
+
+    def flush(self):
+        if len(self._rows)>0:
+            # Rows are only written to the columns that changed on them, so
+            # that stale values of other columns don't overwrite newer ones
+            pkname = self._dbproxy._oag.dbpkname
+            groups = {}
+            for row in self._rows.values():
+                groups.setdefault(tuple(sorted(c for c in row if c!=pkname)), []).append(row)
+
+            try:
+                if len(groups)==1:
+                    ((columns, rows),) = groups.items()
+                    self._dbproxy.update_rows(rows, list(columns))
+                else:
+                    with OADbTransaction("batch update"):
+                        for columns, rows in groups.items():
+                            self._dbproxy.update_rows(rows, list(columns))
+            except:
+                self.discard()
+                raise
+
+            if self._broadcast:
+                self._dbproxy.broadcast()
+        self.clear()
+
+    def clear(self):
+        self._rows = {}
+        self._originals = {}
+        self._broadcast = False
+
+    def stage(self, cframe, columns, original, broadcast=False):
+        """Stage columns of cframe to be written. original holds the values
+        of columns before they were patched into the RDF."""
+        pkname = self._dbproxy._oag.dbpkname
+        pk = cframe.get(pkname)
+        if pk is None:
+            raise OAError("Cannot batch update OAG that has not been materialized")
+        row = self._rows.setdefault(pk, {pkname : pk})
+        row.update({column : cframe.get(column) for column in columns})
+        original = dict(original, **self._originals.get(pk, {}))
+        self._originals[pk] = original
+        self._broadcast = self._broadcast or broadcast
 
-from openarc.exception import OAGraphRetrieveError, OAGraphStorageError, OAGraphIntegrityError
+    @property
+    def size(self):
+
+        return len(self._rows)
 
 class DbSchemaProxy(object):
     def __init__(self, dbproxy):
@@ -45,11 +137,12 @@ class DbSchemaProxy(object):
                 if ('relation "%s.%s" does not exist' % (oag.context, oag.dbtable)) in str(e.underlyer):
                     oalog.debug(f"Creating missing table [{oag.dbtable}]", f='sql')
                     tran.dao.execute(dbp.SQL['admin']['mktable'])
+                    oactx.db_pool.schema_changed()
                     tran.dao.execute(dbp.SQL['admin']['table'], cdict=False, extcur=extcur)
                     db_columns = [desc[0] for desc in extcur[0].description]
 
             # Check for table schema integrity
-            oag_columns     = sorted(oag.streams.keys())
+            oag_columns     = sorted(oag.oagschema.streams.keys())
             db_columns_ext  = [desc for desc in db_columns if desc[0] != '_']
             db_columns_reqd = [oag.stream_db_mapping[k] for k in sorted(oag.stream_db_mapping.keys())]
 
@@ -63,51 +156,298 @@ class DbSchemaProxy(object):
                 add_col_clauses = []
                 for i, col in enumerate(oag_columns):
                     if db_columns_reqd[i] in add_cols:
-                        if oag_columns[i] != db_columns_reqd[i]:
-                            subnode = oag.streams[col][0](rpc=False).db.schema.init(crstack=crstack)
-                            add_clause = "ADD COLUMN %s int %s references %s.%s(%s)"\
-                                         % (self._dbproxy._oag.stream_db_mapping[col],
-                                           'NOT NULL' if oag.streams[col][1] else str(),
-                                            subnode.context,
-                                            subnode.dbtable,
-                                            subnode.dbpkname)
-                        else:
-                            # Could be straight definition of database type, or enum. If enum,
-                            # force column type to int. Optionality is determined by true/false
-                            # on the second field of the declaration for enums.
-                            if type(oag.streams[col][0])==str:
-                                add_clause = "ADD COLUMN %s %s" % (col, oag.streams[col][0])
-                                if oag.streams[col][1] is not None:
-                                    add_clause = "%s NOT NULL" % add_clause
-                            else:
-                                add_clause = "ADD COLUMN %s int" % (col)
-                                if oag.streams[col][1]:
-                                    add_clause = "%s NOT NULL" % add_clause
-
-                        add_col_clauses.append(add_clause)
+                        subnode = None
+                        if oag.is_oagnode(col):
+                            subnode = oag.oagschema.streams[col][0](rpc=False).db.schema.init(crstack=crstack)
+                        add_col_clauses.append("ADD COLUMN %s" % self.column_ddl(oag, col, subnode))
 
                 addcol_sql = dbp.SQLpp("ALTER TABLE {0}.{1} %s") % ",".join(add_col_clauses)
                 tran.dao.execute(addcol_sql)
+                oactx.db_pool.schema_changed()
 
-                for idx, idxinfo in oag.dbindices.items():
-                    col_sql     = ','.join(map(lambda x: oag.stream_db_mapping[x], idxinfo[0]))
-
-                    unique_sql  = str()
-                    if idxinfo[1]:
-                        unique_sql = 'UNIQUE'
-
-                    partial_sql = str()
-                    if idxinfo[2]:
-                        partial_sql =\
-                            'WHERE %s' % ' AND '.join('%s=%s' % (oag.stream_db_mapping[k], idxinfo[2][k]) for k in idxinfo[2].keys())
-
-                    exec_sql    = dbp.SQL['admin']['mkindex'] % (unique_sql, idx, col_sql, partial_sql)
+                for exec_sql in self.index_ddl(oag):
                     tran.dao.execute(exec_sql)
 
         crstack.pop()
 
         return oag
 
+    @staticmethod
+    def column_ddl(oag, stream, subnode=None):
+        """Column definition of stream, as used in ADD COLUMN clauses. oag is
+        an OAG class, or an instance if its metadata are instance properties;
+        likewise subnode, if given, is the OAG stream refers to."""
+        streaminfo = oag.oagschema.streams[stream]
+        column     = oag.stream_db_mapping[stream]
+
+        if oag.is_oagnode(stream):
+            subcls = subnode if subnode is not None else streaminfo[0]
+            return "%s int %s references %s.%s(%s)"\
+                   % (column,
+                      'NOT NULL' if streaminfo[1] else str(),
+                      subcls.context,
+                      subcls.dbtable,
+                      subcls.dbpkname)
+
+        # Could be straight definition of database type, or enum. If enum,
+        # force column type to int. Optionality is determined by true/false
+        # on the second field of the declaration for enums.
+        if oag.is_scalar(stream):
+            column_sql = "%s %s" % (column, streaminfo[0])
+            if streaminfo[1] is not None:
+                column_sql = "%s NOT NULL" % column_sql
+        else:
+            column_sql = "%s int" % column
+            if streaminfo[1]:
+                column_sql = "%s NOT NULL" % column_sql
+
+        return column_sql
+
+    @staticmethod
+    def index_ddl(oag):
+        """CREATE INDEX statements for the dbindices of oag, a class or an
+        instance as in column_ddl()"""
+        ddl = []
+        for idx, idxinfo in oag.dbindices.items():
+            col_sql     = ','.join(map(lambda x: oag.stream_db_mapping[x], idxinfo[0]))
+
+            unique_sql  = str()
+            if idxinfo[1]:
+                unique_sql = 'UNIQUE'
+
+            partial_sql = str()
+            if idxinfo[2]:
+                partial_sql =\
+                    'WHERE %s' % ' AND '.join('%s=%s' % (oag.stream_db_mapping[k], idxinfo[2][k]) for k in idxinfo[2].keys())
+
+            ddl.append(DbSchemaProxy.SQLpp(oag, DbSchemaProxy.SQL['mkindex']) % (unique_sql, idx, col_sql, partial_sql))
+        return ddl
+
+    @staticmethod
+    def fingerprint(oagclasses):
+        """Digest of the tables, columns and indices oagclasses require"""
+        digest = hashlib.sha256()
+        for oagcls in sorted(oagclasses, key=lambda c: (c.context, c.dbtable)):
+            digest.update(repr((
+                oagcls.context,
+                oagcls.dbtable,
+                [DbSchemaProxy.column_ddl(oagcls, stream) for stream in sorted(oagcls.oagschema.streams)],
+                DbSchemaProxy.index_ddl(oagcls),
+            )).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def bootstrap(oagclasses):
+        """Materialize the tables of all oagclasses at once: read the catalog
+        with a single query, and apply all missing DDL in one statement. The
+        fingerprint of each schema (context) is recorded, so that restarting
+        an unchanged deployment skips the catalog diff entirely.
+
+        Classes whose metadata are instance properties, or that refer to
+        such classes, can't be described without an instance, and are left
+        to DbSchemaProxy.init()."""
+        bycontext = {}
+        for oagcls in oagclasses:
+            subclasses = [oagcls.oagschema.streams[s][0] for s in oagcls.oagschema.streams if oagcls.is_oagnode(s)]
+            if not all(isinstance(c.context, str) for c in [oagcls]+subclasses):
+                oalog.debug(f"[{oagcls.__name__}] has no static context, not bootstrapping", f='sql')
+                continue
+            bycontext.setdefault(oagcls.context, []).append(oagcls)
+        bycontext = {context:sorted(classes, key=lambda c: c.dbtable) for context, classes in sorted(bycontext.items())}
+        fingerprints = {context:DbSchemaProxy.fingerprint(classes) for context, classes in bycontext.items()}
+
+        with OADbTransaction("schema bootstrap") as tran:
+            try:
+                current = tran.dao.execute(DbSchemaProxy.SQL['fingerprint'], [list(bycontext)], savepoint=True)
+            except OAGraphStorageError:
+                current = []
+            current = {row['context']:row['fingerprint'] for row in current}
+
+            stale = [context for context in bycontext if current.get(context)!=fingerprints[context]]
+            if len(stale)==0:
+                oalog.debug(f"Schema fingerprints of {list(bycontext)} are unchanged, skipping diff", f='sql')
+            else:
+                ddl = DbSchemaProxy.__diff(tran.dao, [oagcls for context in stale for oagcls in bycontext[context]])
+                if len(ddl)>0:
+                    oalog.debug(f"Applying {len(ddl)} schema changes", f='sql')
+                    tran.dao.execute(';\n'.join(ddl))
+                    oactx.db_pool.schema_changed()
+                tran.dao.execute(DbSchemaProxy.SQL['mkfingerprint'])
+                for context in stale:
+                    tran.dao.execute(DbSchemaProxy.SQL['setfingerprint'], [context, fingerprints[context]])
+
+            # Once all tables are materialized, read foreign key relationships
+            DbSchemaProxy.load_fkeys()
+
+    @staticmethod
+    def load_fkeys():
+        """Fill in _fkframe of every OAG class from a single read of the
+        foreign keys between OAG schemas. The read is only repeated once
+        DDL has changed the schema. Classes whose context is set per
+        instance are read in the context init_fkeys() last saw."""
+        from ._graph import OAG_RootNode
+
+        generation = oactx.db_pool.schema_generation
+        if oactx.db_fkeys_generation == generation:
+            return
+
+        contexts = {}
+        for oagcls in OAG_RootNode._registry.values():
+            try:
+                context = DbSchemaProxy.__context(oagcls)
+                if context is not None:
+                    contexts[oagcls] = (context, oagcls.dbtable)
+            except (OAError, NotImplementedError):
+                continue
+
+        fkframes = DbSchemaProxy.__read_fkeys({context for (context, dbtable) in contexts.values()})
+
+        for oagcls, fkkey in contexts.items():
+            oagcls._fkframe = fkframes.get(fkkey, [])
+
+        oactx.db_fkeys_generation = generation
+
+    @staticmethod
+    def __context(oagcls):
+        """Schema of oagcls, or None if it is set per instance and no
+        instance has been seen yet"""
+        if isinstance(oagcls.context, str):
+            return oagcls.context
+        return oagcls.__dict__.get('_fkcontext')
+
+    @staticmethod
+    def __read_fkeys(contexts):
+        """Foreign keys between tables in contexts, by referenced table"""
+        contexts = sorted(contexts)
+
+        fkframes = {}
+        with OADbTransaction("load fkeys") as tran:
+            for fk in tran.dao.execute(DbSchemaProxy.SQL['fkeys'], [contexts, contexts]):
+                # Foreign key streams refer to a single column
+                if len(fk['ids'])>1:
+                    oalog.debug(f"Skipping multi-column foreign key [{fk['constraint_name']}] on [{fk['schema']}.{fk['table']}]", f='sql')
+                    continue
+                fk['id'] = fk.pop('ids')[0]
+                fk['points_to_id'] = fk.pop('points_to_ids')[0]
+                fkframes.setdefault((fk['points_to_schema'], fk['points_to_table_name']), []).append(fk)
+
+        return fkframes
+
+    @staticmethod
+    def __diff(dao, oagclasses):
+        """DDL needed to bring the database in line with oagclasses: schemas
+        first, then tables, then columns, so that foreign key columns can
+        refer to any table, and finally indices"""
+        contexts = sorted({oagcls.context for oagcls in oagclasses})
+
+        schemas = set()
+        catalog = {}
+        for row in dao.execute(DbSchemaProxy.SQL['catalog'], [contexts]):
+            schemas.add(row['schema'])
+            if row['table'] is not None:
+                columns = catalog.setdefault((row['schema'], row['table']), set())
+                if row['column'] is not None:
+                    columns.add(row['column'])
+
+        mkschemas = [DbSchemaProxy.SQL['mkschema'].format(context) for context in contexts if context not in schemas]
+        mktables  = []
+        addcols   = []
+        mkindices = []
+        for oagcls in oagclasses:
+            db_columns = catalog.get((oagcls.context, oagcls.dbtable))
+            if db_columns is None:
+                oalog.debug(f"Creating missing table [{oagcls.dbtable}]", f='sql')
+                mktables.append(DbSchemaProxy.SQLpp(oagcls, DbSchemaProxy.SQL['mktable']))
+                db_columns = set()
+
+            dropped_cols = sorted(dbc for dbc in db_columns if dbc[0] != '_' and dbc not in oagcls.db_stream_mapping)
+            if len(dropped_cols)>0:
+                raise OAGraphIntegrityError("Dropped columns %s detected on [%s], cannot initialize" % (dropped_cols, oagcls.dbtable))
+
+            add_streams = [stream for stream in sorted(oagcls.oagschema.streams) if oagcls.stream_db_mapping[stream] not in db_columns]
+            if len(add_streams)>0:
+                oalog.debug(f"Adding new columns {add_streams} to [{oagcls.dbtable}]", f='sql')
+                addcols.append(DbSchemaProxy.SQLpp(oagcls, "ALTER TABLE {0}.{1} %s")
+                               % ",".join("ADD COLUMN %s" % DbSchemaProxy.column_ddl(oagcls, stream) for stream in add_streams))
+                mkindices += DbSchemaProxy.index_ddl(oagcls)
+
+        return mkschemas + mktables + addcols + mkindices
+
+    @staticmethod
+    def SQLpp(oag, SQL):
+        """Populates schema{0}.table{1} and its primary key{2} in given SQL
+        string. oag is a class or an instance as in column_ddl()"""
+        return SQL.format(oag.context, oag.dbtable, oag.dbpkname)
+
+    # DDL and catalog queries shared by all OAG classes
+    SQL = {
+      "catalog"        : """
+          SELECT n.nspname as schema,
+                 c.relname as table,
+                 a.attname as column
+            FROM pg_catalog.pg_namespace as n
+                 LEFT JOIN pg_catalog.pg_class as c
+                     ON c.relnamespace=n.oid
+                     AND c.relkind IN ('r', 'p')
+                 LEFT JOIN pg_catalog.pg_attribute as a
+                     ON a.attrelid=c.oid
+                     AND a.attnum>0
+                     AND NOT a.attisdropped
+           WHERE n.nspname=ANY(%s)""",
+      "fingerprint"    : """
+          SELECT context,
+                 fingerprint
+            FROM openarc.schema_fingerprint
+           WHERE context=ANY(%s)""",
+      "fkeys"          : """
+          SELECT con.conname as constraint_name,
+                 ns.nspname as schema,
+                 cl.relname as table,
+                 fns.nspname as points_to_schema,
+                 fcl.relname as points_to_table_name,
+                 array_agg(att.attname::text ORDER BY key.ord) as ids,
+                 array_agg(fatt.attname::text ORDER BY key.ord) as points_to_ids
+            FROM pg_catalog.pg_constraint as con
+                 CROSS JOIN LATERAL unnest(con.conkey, con.confkey)
+                     WITH ORDINALITY as key(attnum, fattnum, ord)
+                 INNER JOIN pg_catalog.pg_class as cl
+                     ON cl.oid=con.conrelid
+                 INNER JOIN pg_catalog.pg_namespace as ns
+                     ON ns.oid=cl.relnamespace
+                 INNER JOIN pg_catalog.pg_attribute as att
+                     ON att.attrelid=con.conrelid
+                     AND att.attnum=key.attnum
+                 INNER JOIN pg_catalog.pg_class as fcl
+                     ON fcl.oid=con.confrelid
+                 INNER JOIN pg_catalog.pg_namespace as fns
+                     ON fns.oid=fcl.relnamespace
+                 INNER JOIN pg_catalog.pg_attribute as fatt
+                     ON fatt.attrelid=con.confrelid
+                     AND fatt.attnum=key.fattnum
+           WHERE con.contype='f'
+             AND ns.nspname=ANY(%s)
+             AND fns.nspname=ANY(%s)
+        GROUP BY con.oid, con.conname, ns.nspname, cl.relname, fns.nspname, fcl.relname
+        ORDER BY ns.nspname, cl.relname, ids""",
+      "mkfingerprint"  : """
+          SELECT public.frieze_schema_create('openarc');
+          CREATE TABLE IF NOT EXISTS openarc.schema_fingerprint(
+              context text PRIMARY KEY,
+              fingerprint text NOT NULL,
+              applied timestamp NOT NULL DEFAULT now())""",
+      "mkindex"        : """
+         CREATE %s INDEX IF NOT EXISTS {1}_%s ON {0}.{1} (%s) %s""",
+      "mkschema"       : """
+         SELECT public.frieze_schema_create('{0}')""",
+      "mktable"        : """
+          CREATE table {0}.{1}({2} serial primary key)""",
+      "setfingerprint" : """
+          INSERT INTO openarc.schema_fingerprint(context, fingerprint) VALUES (%s, %s)
+              ON CONFLICT (context) DO UPDATE
+                 SET fingerprint=EXCLUDED.fingerprint,
+                     applied=now()""",
+    }
+
     def init_fkeys(self):
         dbp = self._dbproxy
         oag = dbp._oag
@@ -116,20 +456,21 @@ class DbSchemaProxy(object):
         if oag.rpc.is_proxy:
             return
 
-        with OADbTransaction("init fkey") as tran:
-            for stream in oag.streams:
-                if oag.is_oagnode(stream):
-                    currattr = getattr(oag, stream, None)
-                    if currattr:
-                        currattr.db.schema.init_fkeys()
+        # The context of this class is only known from its instances
+        oagcls = oag.__class__
+        if not isinstance(oagcls.context, str) and oagcls.__dict__.get('_fkcontext')!=oag.context:
+            oagcls._fkcontext = oag.context
+            oactx.db_fkeys_generation = None
+
+        # Subnodes resolve foreign keys pointing at them from their class's
+        # _fkframe when first dereferenced, so they need not be visited here
+        self.load_fkeys()
 
-            results = tran.dao.execute(dbp.SQL['admin']['fkeys'])
-            setattr(oag.__class__, '_fkframe', results)
-            dbp._oag.reset(idxreset=False)
+        dbp._oag.reset(idxreset=False)
 
 class DbProxy(object):
     """Responsible for manipulation of database"""
-    def __init__(self, oag, searchprms, searchidx, searchwin, searchoffset, searchdesc, initschema, throw_on_empty):
+    def __init__(self, oag, searchprms, searchidx, searchwin, searchoffset, searchdesc, initschema, throw_on_empty, stream=False, itersize=None, searchorder=None):
         from ._graph import OAG_RootNode
 
         # Store reference to outer object
@@ -158,8 +499,34 @@ class DbProxy(object):
         self._searchoffset   = searchoffset
         self._searchdesc     = searchdesc
 
+        # Streams to order search results by ahead of the primary key; a
+        # leading '-' sorts that stream in descending order
+        self._searchorder    = []
+        for key in (searchorder if searchorder else []):
+            orderstream = key.lstrip('-')
+            if orderstream not in self._oag.oagschema.streams:
+                raise OAError("Invalid searchorder stream [%s]" % orderstream)
+            self._searchorder.append((self._oag.stream_db_mapping[orderstream], key[0]=='-'))
+        self._searchorder    = tuple(self._searchorder)
+
+        # Primary key the current page of a keyset paginated search follows
+        self._keyset         = None
+
         self._throw_on_empty = throw_on_empty
 
+        # Stream search results through a server side cursor, itersize rows
+        # at a time, instead of loading them all
+        self._stream         = stream
+        self._itersize       = itersize if itersize else oaenv.dbinfo.get('itersize', 2000)
+        if self._stream and self._oag.is_unique:
+            raise OAError("Cannot stream OAG that is marked unique")
+
+        # Active update batch, if any
+        self._batch = None
+
+        # Subnode rows loaded by prefetch(), by stream and then id
+        self._prefetched = {}
+
         if not self._oag.streamable\
             and oaenv.dbinfo['on_demand_schema']\
             and self._initschema:
@@ -169,6 +536,85 @@ class DbProxy(object):
     def _dao(self):
         return OADao(self._oag.context) if not oactx.db_txndao else oactx.db_txndao
 
+    # Aggregate functions aggregate() will generate SQL for
+    aggregate_functions = ['avg', 'count', 'max', 'min', 'sum']
+
+    def aggregate(self, group_by=[], where=None, **aggregates):
+        """Aggregate the class table in the database, without loading rows:
+
+            oag.db.aggregate(group_by=['ticker'], price=['min', 'max'])
+
+        Keyword arguments map streams to one or more of avg, count, max, min
+        and sum. If the OAG has search parameters only the rows it searches
+        are aggregated, and where (a dict of where() conditions) narrows them
+        further. Returns a dict of lists with one entry per group: the
+        group_by streams, <stream>_<function> per aggregate and count."""
+        def column(stream):
+            if stream != 'id' and stream not in self._oag.oagschema.streams:
+                raise OAGraphIntegrityError("aggregate: invalid stream [%s]" % stream)
+            return self._oag.dbpkname if stream == 'id' else self._oag.stream_db_mapping[stream]
+
+        select_terms = ["%s AS %s" % (column(stream), stream) for stream in group_by]
+        select_terms.append("count(*) AS count")
+        for stream in sorted(aggregates):
+            functions = aggregates[stream]
+            for function in ([functions] if type(functions)==str else functions):
+                if function not in self.aggregate_functions:
+                    raise OAError("aggregate: unknown function [%s]" % function)
+                select_terms.append("%s(%s) AS %s_%s" % (function, column(stream), stream, function))
+
+        if self._searchprms:
+            source = "(%s) AS %s" % (self.SQL['read'][self._searchidx], self._oag.dbtable)
+            params = list(self._searchprms)
+        else:
+            source = "%s.%s" % (self._oag.context, self._oag.dbtable)
+            params = []
+
+        where_sql = str()
+        if where:
+            (clause, where_params) = RdfWhere(self._oag, where).sql()
+            where_sql = " WHERE %s" % clause
+            params += where_params
+
+        group_sql = str()
+        if len(group_by)>0:
+            group_cols = ', '.join([column(stream) for stream in group_by])
+            group_sql = " GROUP BY %s ORDER BY %s" % (group_cols, group_cols)
+
+        aggregate_sql = "SELECT %s FROM %s%s%s" % (', '.join(select_terms), source, where_sql, group_sql)
+
+        rows = self._dao.execute(aggregate_sql, params)
+
+        keys = [term.split(' AS ')[1] for term in select_terms]
+        return {key : [row[key] for row in rows] for key in keys}
+
+    def batch(self):
+        """Context manager deferring update() calls. Changed rows are patched
+        into the RDF immediately, and written to the database with a single
+        UPDATE ... FROM (VALUES ...) on exit:
+
+            with multinode.db.batch():
+                for node in multinode:
+                    node.price = reprice(node)
+                    node.db.update()
+        """
+        return DbBatch(self)
+
+    def broadcast(self):
+        """Tell listening OAGs that this OAG has been updated"""
+        from ._graph import OAG_RpcDiscoverable
+        remote_oags =\
+            OAG_RpcDiscoverable({
+                'rpcinfname' : self._oag.infname_semantic
+            }, 'by_rpcinfname_idx', rpc=False)
+
+        listeners = [r.url for r in remote_oags if (r.listen is True and r.is_valid)]
+
+        print('sending mesages to: %s' % listeners)
+        from openarc._rpc import OARpc_REQ_Request
+        for listener in listeners:
+            OARpc_REQ_Request(self._oag).update_broadcast(listener)
+
     def clone(self, src):
         self._schema     = src.db.schema
         self._searchprms = src.db.searchprms
@@ -192,13 +638,12 @@ class DbProxy(object):
         formatstrs = ', '.join(['%s' for v in vals])
         insert_sql = self.SQL['insert']['id'] % (attrstr, formatstrs)
 
-        results = self._dao.execute(insert_sql, vals)
+        results = self._dao.execute(insert_sql, vals, prepare=True)
         if self._searchidx=='id':
             index_val = results
             self._searchprms = list(index_val[0].values())
             if not is_materialized and self._oag.rdf._rdf:
-                for pk, idx in index_val[0].items():
-                    self._oag.rdf._rdf_window[self._oag._iteridx-1][pk] = idx
+                self._oag.rdf.patch(self._oag.rdf.position(self._oag._iteridx-1), index_val[0])
                 norefresh = True
 
         if not norefresh:
@@ -225,21 +670,108 @@ class DbProxy(object):
 
         return self._oag
 
+    def create_many(self, initprms=[]):
+        """Persist every row of the RDF with one multi-row INSERT. Generated
+        primary keys are backfilled into the RDF; rows are not re-read from
+        the database. initprms, if supplied, is a table as accepted by the
+        OAG constructor."""
+
+        if oaenv.dbinfo['on_demand_schema'] and self._initschema:
+            self.schema.init()
+
+        if len(initprms)>0:
+            self._oag.props._set_cframe_from_userprms(initprms)
+
+        rdf    = self._oag.rdf._rdf
+        pkname = self._oag.dbpkname
+        if not rdf:
+            raise OAError("Cannot create OAG without rows")
+
+        if len([row for row in rdf if row.get(pkname) is not None])>0:
+            raise OAError("Cannot create OAG that has already been materialized")
+
+        columns = sorted({k for row in rdf for k in row if k[0] != '_'})
+
+        missing_streams = []
+        for stream, streaminfo in self._oag.oagschema.streams.items():
+            if self._oag.stream_db_mapping[stream] in columns:
+                continue
+            required = streaminfo[1] is not None if self._oag.is_scalar(stream) else streaminfo[1]
+            if required:
+                missing_streams.append(stream)
+        if len(missing_streams)>0:
+            raise OAGraphIntegrityError("Missing streams detected on [%s]: %s" % (self._oag.dbtable, missing_streams))
+
+        # RETURNING does not promise the order of VALUES: primary keys are
+        # drawn up front for each row index and mapped back through it
+        insert_sql = self.SQL['insert']['many'] % (', '.join(columns),
+                                                   ', '.join(columns),
+                                                   ', '.join(['v.%s::%s' % (col, self.SQLtype(col)) for col in columns]))
+        vals       = [tuple([position]+[dbval(row.get(col)) for col in columns]) for position, row in enumerate(rdf)]
+
+        results = self._dao.execute_values(insert_sql, vals)
+        for result in results:
+            self._oag.rdf.patch(result['_idx'], {pkname : result[pkname]})
+
+        if oaenv.dbinfo['on_demand_schema'] and self._initschema:
+            self.schema.init_fkeys()
+
+        self._oag.reset()
+
+        return self._oag
+
     def delete(self, broadcast=False):
 
         delete_sql = self.SQL['delete']['id']
 
-        self._dao.execute(delete_sql, [self._oag.id])
-        self.search(throw_on_empty_local=False, broadcast=broadcast)
+        self._dao.execute(delete_sql, [self._oag.id], prepare=True)
+        self.__search(throw_on_empty_local=False, broadcast=broadcast)
 
         if self._oag.is_unique:
             self._oag.props._set_attrs_from_cframe_uniq()
 
         return self
 
+    def prefetch(self, *streams):
+        """Fetch the subnodes referenced by oagnode streams across the whole
+        RDF with one query per stream. Dereferencing those streams while
+        iterating then doesn't query the database once per row. Prefetched
+        subnodes are dropped when the OAG is next refreshed."""
+        for stream in streams:
+            if not self._oag.is_oagnode(stream):
+                raise OAGraphIntegrityError("prefetch: [%s] is not a subnode stream" % stream)
+
+            column = self._oag.stream_db_mapping[stream]
+            ids = sorted(set([row.get(column) for row in (self._oag.rdf._rdf or [])]) - {None})
+
+            self._prefetched[stream] = {}
+            if len(ids)>0:
+                subnode = self._oag.oagschema.streams[stream][0](rpc=False)
+                rows = subnode.db._dao.execute(subnode.db.SQL['read']['ids'], [ids], prepare=True)
+                self._prefetched[stream] = {row[subnode.dbpkname]:row for row in rows}
+
+        return self._oag
+
+    def _preload(self, searchprms, rows):
+        """Set search parameters and their results without going to the
+        database, for rows that have already been fetched"""
+        self._searchprms = list(searchprms)
+        self._oag.rdf.load(rows)
+        self._oag.cache.clear()
+        self._oag.reset()
+        if self._oag.is_unique:
+            self._oag.props._set_attrs_from_cframe_uniq()
+
+        return self._oag
+
     def search(self, throw_on_empty_local=True, broadcast=False):
         """Generally we want to simply reset the iterator; set gotodb=True to also
-        refresh instreams from the database"""
+        refresh instreams from the database. Paginated searches go back to the
+        first page."""
+        self._keyset = None
+        return self.__search(throw_on_empty_local=throw_on_empty_local, broadcast=broadcast)
+
+    def __search(self, throw_on_empty_local=True, broadcast=False):
         self.__refresh_from_cursor(broadcast=broadcast)
 
         # Is the new rdf empty? If OAG is marked self._throw_
@@ -251,10 +783,42 @@ class DbProxy(object):
         self._oag.cache.clear()
 
         # Refresh
-        self._oag.reset()
+        self._oag.reset(keepstream=True)
 
         return self._oag
 
+    @property
+    def is_streaming(self):
+        return self._stream
+
+    def next_page(self, throw_on_empty_local=True):
+        """Move the search window to the searchwin rows following the current
+        window. Rows are sought past the sort key (searchorder streams and
+        primary key) of the last row seen instead of being skipped with
+        OFFSET, so every page costs the same to fetch. Searching again goes
+        back to the first page."""
+        if not self._searchwin:
+            raise OAError("next_page: searchwin must be set to paginate")
+
+        if self._stream:
+            raise OAError("next_page: streaming OAGs cannot be paginated")
+
+        if self._searchidx not in self.SQL['page']:
+            raise OAError(f"next_page: [{self._searchidx}] does not support keyset pagination")
+
+        if self._oag.rdf._rdf is None:
+            self.search(throw_on_empty_local=throw_on_empty_local)
+
+        rdf = self._oag.rdf._rdf
+        if len(rdf)==0:
+            if self._throw_on_empty and throw_on_empty_local:
+                raise OAGraphRetrieveError("No results found in database")
+            return self._oag
+
+        self._keyset = tuple([rdf[-1][column] for (column, desc) in self.SQLorderkey])
+
+        return self.__search(throw_on_empty_local=throw_on_empty_local)
+
     @property
     def searchidx(self):
         return self._searchidx
@@ -265,24 +829,46 @@ class DbProxy(object):
 
     def update(self, updparms={}, norefresh=False, broadcast=False):
 
+        row = self._oag.props._cframe
+        rowid = row.get(self._oag.dbpkname)
+
         self._oag.props._set_cframe_from_userprms(updparms)
 
         self.update_searchprms()
 
-        member_attrs  = [k for k in self._oag.props._cframe if k[0] != '_']
+        # Only write streams that changed since the last load; if nothing
+        # changed, don't bother going to the database
+        dirty_attrs = [self._oag.stream_db_mapping[stream] for stream in self._oag.props.dirty]
+        member_attrs = [k for k in self._oag.props._cframe if k[0] != '_' and k in dirty_attrs]
+        if len(member_attrs)==0:
+            return self._oag
+
+        if self._batch is not None:
+            # Patch RDF row; database is updated when batch exits
+            original = {attr : row.get(attr) for attr in member_attrs}
+            row = self._oag.rdf.patch_current(row, self._oag.props._cframe)
+            self._oag.props._cframe = row
+            self._oag.props.clean()
+            self._batch.stage(row, member_attrs, original, broadcast=broadcast)
+            return self._oag
+
         index_key     = [k for k in self._oag.props._cframe if k[0] == '_'][0]
         update_clause = ', '.join(["%s=" % attr + "%s"
                                     for attr in member_attrs])
-        update_sql    = self.SQL['update']['id']\
-                        % (update_clause, getattr(self._oag, index_key, ""))
-        update_values = [self._oag.props._cframe[attr] for attr in member_attrs]
+        update_sql    = self.SQL['update']['id'] % (update_clause, '%s')
+        update_values = [self._oag.props._cframe[attr] for attr in member_attrs]\
+                        + [getattr(self._oag, index_key, "")]
 
-        self._dao.execute(update_sql, update_values)
+        self._dao.execute(update_sql, update_values, prepare=True)
+        self._oag.props.clean()
         if not norefresh:
             self.__refresh_from_cursor(broadcast=broadcast)
 
         if not self._oag.is_unique and len(self._oag.rdf._rdf_window)>0:
-            self._oag.__getitem__(self._oag.rdf._rdf_window_index, preserve_cache=True)
+            # The refreshed window may be ordered differently: follow the row
+            # that was updated
+            position = self._oag.rdf.find(rowid)
+            self._oag.__getitem__(position if position is not None else self._oag.rdf._rdf_window_index, preserve_cache=True)
 
         return self._oag
 
@@ -301,6 +887,22 @@ class DbProxy(object):
 
         return self._oag
 
+    def update_rows(self, rows, columns=None):
+        """Write rows, each a cframe keyed by database column, back to the
+        database with a single UPDATE ... FROM (VALUES ...) keyed on primary
+        key. Only columns are written if supplied."""
+        pkname  = self._oag.dbpkname
+        if columns is None:
+            columns = sorted({k for row in rows for k in row if k[0] != '_'})
+
+        set_clause = ', '.join(['%s=v.%s::%s' % (col, col, self.SQLtype(col)) for col in columns])
+        update_sql = self.SQL['update']['many'] % (set_clause, ', '.join([pkname]+columns))
+        vals       = [tuple([row[pkname]]+[dbval(row.get(col)) for col in columns]) for row in rows]
+
+        self._dao.execute_values(update_sql, vals, fetch=False)
+
+        return self._oag
+
     def update_searchprms(self):
         # Update search parameteres from prop manager
         index = self._searchidx[3:]
@@ -320,39 +922,72 @@ class DbProxy(object):
 
             self._searchprms = new_searchprms
 
-    def __refresh_from_cursor(self, broadcast=False):
-        try:
+    def __read_sql(self, predicates=[]):
+        """Read query for the current search with predicates pushed into its
+        WHERE clause, and its parameters"""
+        if self._keyset is not None:
+            select_sql = self.SQL['page'][self._searchidx]
+            modified_searchprms = list(self._searchprms) + [self._keyset[i] for i in self.SQLpagekey()[1]]
+        else:
             select_sql = self.SQL['read'][self._searchidx]
-
             modified_searchprms = list(self._searchprms)
 
-            if self._searchwin:
-                select_sql += ' LIMIT %s'
-                modified_searchprms = modified_searchprms + [self._searchwin]
-
-            if self._searchoffset:
-                select_sql += ' OFFSET %s'
-                modified_searchprms = modified_searchprms + [self._searchoffset]
+        if len(predicates)>0:
+            where_sql = []
+            for predicate in predicates:
+                (clause, params) = predicate.sql()
+                where_sql.append(clause)
+                modified_searchprms += params
+            select_sql = td("""
+                  SELECT *
+                    FROM ({0}) AS {1}
+                   WHERE {2}
+                ORDER BY {3}""").format(select_sql, self._oag.dbtable, ' AND '.join(where_sql), self.SQLorderby)
+
+        if self._searchwin:
+            select_sql += ' LIMIT %s'
+            modified_searchprms = modified_searchprms + [self._searchwin]
+
+        if self._searchoffset and self._keyset is None:
+            select_sql += ' OFFSET %s'
+            modified_searchprms = modified_searchprms + [self._searchoffset]
+
+        return (select_sql, modified_searchprms)
+
+    def __stream_from_cursor(self, select_sql, searchprms):
+        """Chunks of search results, read lazily through a server side cursor.
+        Outside a transaction a dedicated connection is held until the stream
+        is exhausted or discarded."""
+        txndao = oactx.db_txndao
+        dao = txndao if txndao else OADao(self._oag.context, trans_commit_hold=True)
+        try:
+            for chunk in dao.stream(select_sql, searchprms, itersize=self._itersize):
+                yield chunk
+        finally:
+            if not txndao:
+                dao.cur_finalize(None)
 
-            self._oag.rdf._rdf = self._dao.execute(select_sql, modified_searchprms, savepoint=True)
-            self._oag.rdf._rdf_window = self._oag.rdf._rdf
+    def __refresh_from_cursor(self, broadcast=False):
+        try:
+            # Declarative filters can be run by the database, unless the read
+            # is user defined
+            pushdown = []
+            if self._searchidx in self.SQL['page']:
+                pushdown = [p for p in self._oag.rdf._rdf_filter_cache if isinstance(p, RdfWhere)]
 
-            for predicate in self._oag.rdf._rdf_filter_cache:
-                self._oag.rdf.filter(predicate, cache=True, rerun=True)
+            (select_sql, modified_searchprms) = self.__read_sql(pushdown)
 
-            if broadcast:
-                from ._graph import OAG_RpcDiscoverable
-                remote_oags =\
-                    OAG_RpcDiscoverable({
-                        'rpcinfname' : self._oag.infname_semantic
-                    }, 'by_rpcinfname_idx', rpc=False)
+            self._prefetched = {}
 
-                listeners = [r.url for r in remote_oags if (r.listen is True and r.is_valid)]
+            # Streams reapply cached filters and the sort to every chunk
+            if self._stream:
+                self._oag.rdf.stream_open(self.__stream_from_cursor(select_sql, modified_searchprms), pushdown)
+            else:
+                self._oag.rdf.load(self._dao.execute(select_sql, modified_searchprms, savepoint=True, prepare=True))
+                self._oag.rdf.reapply(pushdown)
 
-                print('sending mesages to: %s' % listeners)
-                from openarc._rpc import OARpc_REQ_Request
-                for listener in listeners:
-                    OARpc_REQ_Request(self._oag).update_broadcast(listener)
+            if broadcast:
+                self.broadcast()
 
         except OAGraphStorageError:
             if self._throw_on_empty:
@@ -364,12 +999,40 @@ class DbProxy(object):
             self._schema = DbSchemaProxy(self)
         return self._schema
 
+    @property
+    def SQLorderby(self):
+        return ', '.join(["%s %s" % (column, 'DESC' if desc else 'ASC') for (column, desc) in self.SQLorderkey])
+
     @property
     def SQLorderdir(self):
         return 'DESC' if self._searchdesc else 'ASC'
 
+    @property
+    def SQLorderkey(self):
+        """Columns search results are ordered by, with their direction: the
+        searchorder, then the primary key as a tie breaker"""
+        orderkey = list(self._searchorder)
+        if self._oag.dbpkname not in [column for (column, desc) in orderkey]:
+            orderkey.append((self._oag.dbpkname, self._searchdesc))
+        return orderkey
+
+    # Compiled SQL catalogs, keyed by OAG class and ordering
+    _sql_catalog = {}
+
     @property
     def SQL(self):
+        """SQL catalog for this OAG class, compiled on first use"""
+        catalog_key = (self._oag.__class__, self._searchdesc, self._searchorder)
+        try:
+            return DbProxy._sql_catalog[catalog_key]
+        except KeyError:
+            catalog = self.SQLcompile()
+            DbProxy._sql_catalog[catalog_key] = catalog
+            return catalog
+
+    def SQLcompile(self):
+        """Build the full SQL catalog: default templates, reads by oagnode
+        stream and by index, and user defined overrides"""
 
         # Default SQL defined for all tables
         default_sql = {
@@ -378,19 +1041,40 @@ class DbProxy(object):
                   SELECT *
                     FROM {0}.{1}
                    WHERE {2}=%s
-                ORDER BY {2} {3}"""),
+                ORDER BY {4}"""),
+              "ids"      : self.SQLpp("""
+                  SELECT *
+                    FROM {0}.{1}
+                   WHERE {2}=ANY(%s)
+                ORDER BY {4}"""),
             },
             "update" : {
               "id"       : self.SQLpp("""
                   UPDATE {0}.{1}
                      SET %s
-                   WHERE {2}=%s""")
+                   WHERE {2}=%s"""),
+              "many"     : self.SQLpp("""
+                  UPDATE {0}.{1}
+                     SET %s
+                    FROM (VALUES %%s) AS v(%s)
+                   WHERE {0}.{1}.{2}=v.{2}""")
             },
             "insert" : {
               "id"       : self.SQLpp("""
              INSERT INTO {0}.{1}(%s)
                   VALUES (%s)
-               RETURNING {2}""")
+               RETURNING {2}"""),
+              "many"     : self.SQLpp("""
+                    WITH v(_idx, %s) AS (VALUES %%s),
+                         ids AS (SELECT _idx, nextval(pg_get_serial_sequence('{0}.{1}', '{2}')) AS {2}
+                                   FROM v),
+                         ins AS (INSERT INTO {0}.{1}({2}, %s)
+                                      SELECT ids.{2}, %s
+                                        FROM v INNER JOIN ids USING (_idx)
+                                   RETURNING {2})
+                  SELECT ids._idx, ids.{2}
+                    FROM ids INNER JOIN ins USING ({2})
+                ORDER BY ids._idx""")
             },
             "delete" : {
               "id"       : self.SQLpp("""
@@ -398,28 +1082,9 @@ class DbProxy(object):
                    WHERE {2}=%s""")
             },
             "admin"  : {
-              "fkeys"    : self.SQLpp("""
-                  SELECT tc.constraint_name,
-                         kcu.column_name as id,
-                         kcu.constraint_schema as schema,
-                         tc.table_name as table,
-                         ccu.table_schema as points_to_schema,
-                         ccu.table_name as points_to_table_name,
-                         ccu.column_name as points_to_id
-                    FROM information_schema.table_constraints as tc
-                         INNER JOIN information_schema.key_column_usage as kcu
-                             ON tc.constraint_name=kcu.constraint_name
-                         INNER JOIN information_schema.constraint_column_usage as ccu
-                             ON ccu.constraint_name = tc.constraint_name
-                   WHERE constraint_type = 'FOREIGN KEY'
-                         AND ccu.table_schema='{0}'
-                         AND ccu.table_name='{1}'"""),
-              "mkindex"  : self.SQLpp("""
-                 CREATE %s INDEX IF NOT EXISTS {1}_%s ON {0}.{1} (%s) %s"""),
-              "mkschema" : self.SQLpp("""
-                 SELECT public.frieze_schema_create('{0}')"""),
-              "mktable"  : self.SQLpp("""
-                  CREATE table {0}.{1}({2} serial primary key)"""),
+              "mkindex"  : self.SQLpp(DbSchemaProxy.SQL['mkindex']),
+              "mkschema" : self.SQLpp(DbSchemaProxy.SQL['mkschema']),
+              "mktable"  : self.SQLpp(DbSchemaProxy.SQL['mktable']),
               "schema"   : self.SQLpp("""
                   SELECT 1
                     FROM information_schema.schemata
@@ -431,16 +1096,29 @@ class DbProxy(object):
             }
         }
 
+        # Keyset pagination: the read's predicates, continued past the sort
+        # key of the last row of the previous page
+        page_sql = self.SQLpp("""
+                  SELECT *
+                    FROM {0}.{1}
+                   WHERE %s
+                         AND %s
+                ORDER BY {4}""")
+        page_prms = (self.SQLpagekey()[0],)
+        default_sql['page'] = {}
+
         # Add in id retrieval for oagprops
-        for stream, streaminfo in self._oag.streams.items():
+        for stream, streaminfo in self._oag.oagschema.streams.items():
             if self._oag.is_oagnode(stream):
                 stream_sql_key = 'by_'+stream
+                stream_col     = streaminfo[0].dbpkname[1:]+'_'+stream
                 stream_sql     = td("""
                   SELECT *
                     FROM {0}.{1}
                    WHERE {2}=%s
-                ORDER BY {3} {4}""").format(self._oag.context, self._oag.dbtable, streaminfo[0].dbpkname[1:]+'_'+stream, self._oag.dbpkname, self.SQLorderdir)
+                ORDER BY {3}""").format(self._oag.context, self._oag.dbtable, stream_col, self.SQLorderby)
                 default_sql['read'][stream_sql_key] = stream_sql
+                default_sql['page'][stream_sql_key] = page_sql % ((stream_col+'=%s',)+page_prms)
 
         # Add in update/delegate by indices
         for index, idxinfo in self._oag.dbindices.items():
@@ -448,7 +1126,7 @@ class DbProxy(object):
                   SELECT *
                     FROM {0}.{1}
                    WHERE %s
-                ORDER BY {2} {3}""")
+                ORDER BY {4}""")
 
             update_sql = self.SQLpp("""
                   UPDATE {0}.{1}
@@ -462,22 +1140,86 @@ class DbProxy(object):
 
             default_sql['read']['by_'+index] = select_sql % ' AND '.join(where_clauses)
             default_sql['update']['by_'+index] = update_sql % ' AND '.join(where_clauses)
+            default_sql['page']['by_'+index] = page_sql % ((' AND '.join(where_clauses),)+page_prms)
 
         # Add in "all" search
         default_sql['read']['by_all'] = self.SQLpp("""
                   SELECT *
                     FROM {0}.{1}
                    WHERE 1=1
-                ORDER BY {2}""")
+                ORDER BY {4}""")
+        default_sql['page']['by_all'] = page_sql % (('1=1',)+page_prms)
 
-        # Add in user defined SQL
+        # Add in user defined SQL. Overridden reads can't be paged by key.
         for action, sqlinfo in self._oag.dblocalsql.items():
             for index, sql in sqlinfo.items():
                 default_sql[action]['by_'+index] = sql.format(self._oag.context, self._oag.dbtable, self._oag.dbpkname)
+                if action == 'read':
+                    default_sql['page'].pop('by_'+index, None)
 
         return default_sql
 
+    def SQLpagekey(self):
+        """Predicate for rows past the sort key of the last row seen, and the
+        position in SQLorderkey of the key value each of its parameters takes.
+        Row comparison only works if every column is sorted in the same
+        direction and none is nullable: it is NULL for NULL keys, and those
+        rows would never be paged to. Other keys are compared column by
+        column, with NULLs sorting last ascending and first descending as in
+        ORDER BY."""
+        page_key = self.SQLorderkey
+        nullable = [self.SQLnullable(column) for (column, desc) in page_key]
+        if True not in nullable and len(set([desc for (column, desc) in page_key]))==1:
+            return ("(%s)%s(%s)" % (', '.join([column for (column, desc) in page_key]),
+                                    '<' if page_key[0][1] else '>',
+                                    ', '.join(['%s']*len(page_key))),
+                    list(range(len(page_key))))
+
+        clauses   = []
+        positions = []
+        for i, (column, desc) in enumerate(page_key):
+            terms = []
+            for j, (prev_column, prev_desc) in enumerate(page_key[:i]):
+                if nullable[j]:
+                    terms.append("%s IS NOT DISTINCT FROM %%s::%s" % (prev_column, self.SQLtype(prev_column)))
+                else:
+                    terms.append("%s=%%s" % prev_column)
+                positions.append(j)
+
+            op = '<' if desc else '>'
+            if nullable[i]:
+                value = "%%s::%s" % self.SQLtype(column)
+                terms.append("(%s%s%s OR (%s IS %sNULL AND %s IS %sNULL))"
+                             % (column, op, value,
+                                column, 'NOT ' if desc else str(),
+                                value, str() if desc else 'NOT '))
+                positions += [i, i]
+            else:
+                terms.append("%s%s%%s" % (column, op))
+                positions.append(i)
+
+            clauses.append("(%s)" % ' AND '.join(terms))
+
+        return ("(%s)" % ' OR '.join(clauses), positions)
+
+    def SQLnullable(self, column):
+        """Can column be NULL? Optionality is declared as in column_ddl()."""
+        if column == self._oag.dbpkname:
+            return False
+        stream = self._oag.db_stream_mapping[column]
+        streaminfo = self._oag.oagschema.streams[stream]
+        if self._oag.is_scalar(stream):
+            return streaminfo[1] is None
+        return not streaminfo[1]
+
+    def SQLtype(self, column):
+        """Database type of column. Subnodes and enums are stored as ints."""
+        stream = self._oag.db_stream_mapping[column]
+        if self._oag.is_scalar(stream):
+            return self._oag.oagschema.streams[stream][0]
+        return 'int'
+
     def SQLpp(self, SQL):
-        """Pretty prints SQL and populates schema{0}.table{1} and its primary
-        key{2} in given SQL string"""
-        return SQL.format(self._oag.context, self._oag.dbtable, self._oag.dbpkname, self.SQLorderdir)
+        """Pretty prints SQL and populates schema{0}.table{1}, its primary
+        key{2}, sort direction{3} and ORDER BY terms{4} in given SQL string"""
+        return SQL.format(self._oag.context, self._oag.dbtable, self._oag.dbpkname, self.SQLorderdir, self.SQLorderby)
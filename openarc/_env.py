@@ -12,7 +12,6 @@ import datetime
 import gevent
 import gevent.queue
 import inflection
-import inspect
 import locale
 import logging
 import os
@@ -137,6 +136,11 @@ class OALogManager(OASingleton):
         if f is None or getattr(self, f.upper(), None):
             self._logger.debug(msg, *args, **kwargs)
 
+    def is_debug(self, f=None):
+        """Would debug messages for family f be logged? Use to skip building
+        expensive messages."""
+        return (f is None or bool(getattr(self, f.upper(), None))) and self._logger.isEnabledFor(logging.DEBUG)
+
     def error(self, msg, *args, **kwargs):
         self._logger.error(msg, *args, **kwargs)
 
@@ -175,11 +179,14 @@ class OAGlobalContext(object):
         # Cache database-to-class mappings
         self._db_class_mapping = {}
 
-        # Database connection for this context
-        self._db_conn = None
+        # Database connection pool for this context
+        self._db_pool = None
+
+        # Schema generation the foreign keys of OAG classes were read at
+        self._db_fkeys_generation = None
 
-        # Global transaction
-        self._db_txn = None
+        # Open transactions, one per greenlet
+        self._db_txn = {}
 
         # Rpc Router
         self._rpcrtr = None
@@ -198,27 +205,34 @@ class OAGlobalContext(object):
         return class_name
 
     @property
-    def db_conn(self):
-        if self._db_conn is None:
-            import psycopg2
-            dbinfo = oaenv.dbinfo
-            print("intializing database connection")
-            self._db_conn = psycopg2.connect(dbname=dbinfo['dbname'],
-                                             user=dbinfo['user'],
-                                             password=dbinfo['password'],
-                                             host=dbinfo['host'],
-                                             port=dbinfo['port'])
-        return self._db_conn
+    def db_pool(self):
+        if self._db_pool is None:
+            from ._dao import OADbPool
+            oalog.debug("Initializing database connection pool", f='sql')
+            self._db_pool = OADbPool(oaenv.dbinfo)
+        return self._db_pool
+
+    @property
+    def db_fkeys_generation(self):
+
+        return self._db_fkeys_generation
+
+    @db_fkeys_generation.setter
+    def db_fkeys_generation(self, generation):
+
+        self._db_fkeys_generation = generation
 
     @property
     def db_txndao(self):
 
-        return self._db_txn
+        return self._db_txn.get(gevent.greenlet.getcurrent())
 
     @db_txndao.setter
     def db_txndao(self, newtxn):
-
-        self._db_txn = newtxn
+        if newtxn is None:
+            self._db_txn.pop(gevent.greenlet.getcurrent(), None)
+        else:
+            self._db_txn[gevent.greenlet.getcurrent()] = newtxn
 
     def put_ka(self, oag):
         try:
@@ -371,35 +385,24 @@ class OAEnv(OASingleton):
 
             # Force refresh of some class variables to ensure previous
             # runs of initoag didn't leave them corrupted
-            if oag:
-                setattr(oag.__class__, '_dbtable_name',      None)
-                setattr(oag.__class__, '_stream_db_mapping', None)
+            if oag and '_oagschema' in vars(oag.__class__):
+                delattr(oag.__class__, '_oagschema')
 
-            create_index = {}
+            # Nothing to do until OAG classes have been defined
+            graph = sys.modules.get('openarc._graph')
+            if graph is None:
+                return
 
-            modules = sorted(sys.modules)
-            for module in modules:
+            oagclasses = []
+            for oagcls in graph.OAG_RootNode._registry.values():
                 try:
-                    fns = inspect.getmembers(sys.modules[module], inspect.isclass)
-                except:
+                    if oagcls.streamable and oagcls.is_reversible and oagcls.context:
+                        oagclasses.append(oagcls)
+                except (OAError, NotImplementedError):
                     continue
 
-                # If classes are OAG_RootNodes, create their tables in the database
-                for fn in fns:
-                    if 'OAG_RootNode' in [x.__name__ for x in inspect.getmro(fn[1])] and fn[1].__name__ != 'OAG_RootNode':
-                        if fn[1].__name__ not in create_index:
-                            try:
-                                if fn[1].streamable:
-                                    create_index[fn[1].__name__] = fn[1]().db.schema.init()
-                            except OAError:
-                                pass
-
-            # Once all tables are materialized, we need to create foreign key relationships
-            for fn in create_index:
-                try:
-                    create_index[fn].db.schema.init_fkeys()
-                except OAError:
-                    pass
+            from ._db import DbSchemaProxy
+            DbSchemaProxy.bootstrap(oagclasses)
 
     def init_logging(self, name, reset=False):
         # Global logger
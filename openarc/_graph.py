@@ -5,29 +5,121 @@ __all__ = [
 ]
 
 import attrdict
+import collections
 import datetime
 import hashlib
 import inflection
-import inspect
 import os
 import signal
 import socket
 import sys
+import types
 
 from ._db   import *
 from ._env  import *
 from ._rdf  import *
 from ._rpc  import reqcls, RpcTransaction, RpcProxy, RestProxy, RpcACL
-from ._util import oagprop, staticproperty
+from ._util import oagprop, staticproperty, streamprop
 
 from openarc.exception import *
 from openarc.time      import *
 
+class OAGSchema(collections.namedtuple('OAGSchema', [
+        'dbtable',
+        'dbpkname',
+        'is_reversible',
+        'streams',
+        'kinds',
+        'stream_db_mapping',
+        'db_stream_mapping',
+        'infname_streams'])):
+    """Immutable digest of an OAG class's metadata: table and primary key
+    names, its streams as declared, the kind of each stream, the column it
+    is stored in and the streams infname is calculated from"""
+
+    SCALAR  = 'scalar'
+    ENUM    = 'enum'
+    OAGNODE = 'oagnode'
+
+    __slots__ = ()
+
+    # Row classes generated for rows(), by OAG class and streams
+    _rowclasses = {}
+
+    @staticmethod
+    def tablename(oagcls):
+        return inflection.underscore(oagcls.__name__)[4:]
+
+    @classmethod
+    def compile(cls, oagcls):
+        dbtable  = cls.tablename(oagcls)
+        streams  = dict(oagcls.streams)
+
+        kinds = {}
+        stream_db_mapping = {}
+        for stream, streaminfo in streams.items():
+            if type(streaminfo[0])==str:
+                kinds[stream] = cls.SCALAR
+                stream_db_mapping[stream] = stream
+            elif isinstance(streaminfo[0], type) and issubclass(streaminfo[0], OAG_RootNode):
+                # Use the table name rather than the schema of the referenced
+                # class, which may in turn refer back to this one
+                kinds[stream] = cls.OAGNODE
+                stream_db_mapping[stream] = "%s_id_%s" % (cls.tablename(streaminfo[0]), stream)
+            else:
+                kinds[stream] = cls.ENUM
+                stream_db_mapping[stream] = stream
+
+        return cls(
+            dbtable,
+            "_%s_id" % dbtable,
+            "OAG_"+inflection.camelize(dbtable)==oagcls.__name__,
+            types.MappingProxyType(streams),
+            types.MappingProxyType(kinds),
+            types.MappingProxyType(stream_db_mapping),
+            types.MappingProxyType({v:k for k, v in stream_db_mapping.items()}),
+            frozenset(oagcls.infname_fields))
+
+    @classmethod
+    def rowclass(cls, oagcls, streams):
+        """Read-only row class holding id and streams, built once per OAG
+        class"""
+        try:
+            return cls._rowclasses[(oagcls, streams)]
+        except KeyError:
+            rowcls = collections.namedtuple(oagcls.__name__+'Row', ('id',)+streams)
+            return cls._rowclasses.setdefault((oagcls, streams), rowcls)
+
 class OAG_RootNode(object):
 
     ##### Class variables
     _fkframe = []
 
+    ##### Class registry
+    _registry = {}
+    _registry_generation = 0
+
+    def __init_subclass__(cls, proxy=False, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not proxy:
+            OAG_RootNode._registry[cls.__name__] = cls
+            OAG_RootNode._registry_generation += 1
+
+            # Streams referring to OAG classes defined further down a module
+            # can't be resolved yet: those classes compile on first use
+            try:
+                cls._oagschema = OAGSchema.compile(cls)
+            except (NameError, NotImplementedError, OAError):
+                pass
+
+    @staticmethod
+    def graphclass(name=None, table=None):
+        """OAG class registered under a class name, or backed by a database
+        table; None if there is no such class"""
+        if table is not None:
+            name = oactx.db_class_mapping(table)
+        return OAG_RootNode._registry.get(name)
+
     ##### Proxies
     @property
     def cache(self):
@@ -82,6 +174,17 @@ class OAG_RootNode(object):
     @staticproperty
     def nonstream_deps(cls): return []
 
+    @staticproperty
+    def rdfbackend(cls):
+        """Storage for search results: 'rows' (a dict per row) or 'columnar'
+        (a typed array per column, requires numpy)"""
+        return 'rows'
+
+    @staticproperty
+    def rdfindices(cls):
+        """In-memory indexes over loaded RDFs: {stream : 'hash'|'sorted'}"""
+        return {}
+
     @staticproperty
     def restapi(cls): return {}
 
@@ -95,73 +198,73 @@ class OAG_RootNode(object):
 
     ##### Derivative fields
     @staticproperty
-    def dbpkname(cls): return "_%s_id" % cls.dbtable
+    def oagschema(cls):
+        """Class metadata compiled into an OAGSchema when the class is
+        defined, or on first use if its streams couldn't be resolved then"""
+        try:
+            return cls.__dict__['_oagschema']
+        except KeyError:
+            cls._oagschema = OAGSchema.compile(cls)
+            return cls._oagschema
+
+    @staticproperty
+    def dbpkname(cls): return cls.oagschema.dbpkname
 
     @staticproperty
     def dbtable(cls):
-        ca_prop = getattr(cls, '_dbtable_name', ())
-        if not ca_prop or (len(ca_prop)>0 and ca_prop[0]!=cls):
-            db_table_name = inflection.underscore(cls.__name__)[4:]
-            setattr(cls, '_dbtable_name', (cls, db_table_name))
-            if not cls.is_reversible:
-                raise OAError("This table name isn't reversible: [%s]" % cls.__name__)
-        return cls._dbtable_name[1]
+        schema = cls.oagschema
+        if not schema.is_reversible:
+            raise OAError("This table name isn't reversible: [%s]" % cls.__name__)
+        return schema.dbtable
 
     @classmethod
     def is_oagnode(cls, stream):
-        try:
-            streaminfo = cls.streams[stream][0]
-            if type(streaminfo).__name__=='type':
-                return 'OAG_RootNode' in [x.__name__ for x in inspect.getmro(streaminfo)]
-            else:
-                return False
-        except KeyError:
-            return False
+        return cls.oagschema.kinds.get(stream)==OAGSchema.OAGNODE
 
     @classmethod
     def is_scalar(cls, stream):
-        try:
-            return type(cls.streams[stream][0])==str
-        except KeyError:
-            # Stay with me here: if there's a key error, you've either fed this
-            # function junk data, or an internal member beginning with '_'; return
-            # True.
-            return True
+        # Stay with me here: if the stream is unknown, you've either fed this
+        # function junk data, or an internal member beginning with '_'; return
+        # True.
+        return cls.oagschema.kinds.get(stream, OAGSchema.SCALAR)==OAGSchema.SCALAR
 
     @classmethod
     def is_enum(cls, stream):
-        try:
-            return cls.is_scalar(stream)==False and cls.is_oagnode(stream)==False
-        except KeyError:
-            return False
+        return cls.oagschema.kinds.get(stream)==OAGSchema.ENUM
 
     @staticproperty
-    def is_reversible(cls):
-        ca_prop = getattr(cls, '_is_reversible', ())
-        if not ca_prop or (len(ca_prop)>0 and ca_prop[0]!=cls):
-            reverse_class_name = "OAG_"+inflection.camelize(cls.dbtable)
-            setattr(cls, '_is_reversible', (cls, reverse_class_name == cls.__name__))
-        return cls._is_reversible[1]
+    def is_reversible(cls): return cls.oagschema.is_reversible
 
     @staticproperty
-    def stream_db_mapping(cls):
-        ca_prop = getattr(cls, '_stream_db_mapping', ())
-        if not ca_prop or (len(ca_prop)>0 and ca_prop[0]!=cls):
-            schema = {}
-            for stream, streaminfo in cls.streams.items():
-                if cls.is_oagnode(stream):
-                    schema[stream] = streaminfo[0].dbpkname[1:]+'_'+stream
-                else:
-                    schema[stream] = stream
-            setattr(cls, '_stream_db_mapping', (cls, schema))
-        return cls._stream_db_mapping[1]
+    def stream_db_mapping(cls): return cls.oagschema.stream_db_mapping
+
+    @staticproperty
+    def fkstreams(cls):
+        """Streams generated for foreign keys pointing at this class, as
+        (stream, class, referenced column, search index) tuples. Recomputed
+        only when the foreign keys or the class registry change."""
+        ca_prop = getattr(cls, '_fkstreams', ())
+        if not ca_prop\
+            or ca_prop[0]!=cls\
+            or ca_prop[1] is not cls._fkframe\
+            or ca_prop[2]!=OAG_RootNode._registry_generation:
+            fkstreams = []
+            for fk in cls._fkframe:
+                cfcls = OAG_RootNode.graphclass(table=fk['table'])
+                if cfcls is None:
+                    continue
+
+                # Generate name of new stream
+                stream = fk['table']
+                if len([f for f in cls._fkframe if f['table']==fk['table']])>1:
+                    stream+='_'+cfcls.db_stream_mapping[fk['id']]
+
+                fkstreams.append((stream, cfcls, fk['points_to_id'], 'by_'+cfcls.db_stream_mapping[fk['id']]))
+            setattr(cls, '_fkstreams', (cls, cls._fkframe, OAG_RootNode._registry_generation, fkstreams))
+        return cls._fkstreams[3]
 
     @staticproperty
-    def db_stream_mapping(cls):
-        ca_prop = getattr(cls, '_db_stream_mapping', ())
-        if not ca_prop or (len(ca_prop)>0 and ca_prop[0]!=cls):
-            setattr(cls, '_db_stream_mapping', (cls, {cls.stream_db_mapping[k]:k for k in cls.stream_db_mapping}))
-        return cls._db_stream_mapping[1]
+    def db_stream_mapping(cls): return cls.oagschema.db_stream_mapping
 
     ##### User API
     @property
@@ -176,12 +279,55 @@ class OAG_RootNode(object):
         if len(self.props._cframe)==0:
             raise OAError("Cannot calculate infname if OAG attributes have not set")
 
+        # Memoized for the current cframe, until one of infname_fields is
+        # changed or invalidated
+        memo = self.props._infname
+        if memo is not None and memo[0] is self.props._cframe:
+            return memo[1]
+
         hashstr = str()
         for stream in self.infname_fields:
             node = getattr(self, stream, None)
             hashstr += node.infname if self.is_oagnode(stream) and node else str(node)
 
-        return hashlib.sha256(hashstr.encode('utf-8')).hexdigest()
+        digest = hashlib.sha256(hashstr.encode('utf-8')).hexdigest()
+        self.props._infname = (self.props._cframe, digest)
+
+        return digest
+
+    def infnames(self):
+        """infname of every row in the current window, computed in one batch:
+        subnodes are read with one query per subnode stream instead of being
+        dereferenced row by row"""
+        return self._infnames(self.rdf._rdf_window or [])
+
+    def _infnames(self, rows):
+        subinfnames = {}
+        for stream in self.infname_fields:
+            if self.is_oagnode(stream):
+                column = self.stream_db_mapping[stream]
+                ids = sorted(set([row.get(column) for row in rows]) - {None})
+
+                subinfnames[stream] = {}
+                if len(ids)>0:
+                    subnode = self.oagschema.streams[stream][0](rpc=False)
+                    subrows = subnode.db._dao.execute(subnode.db.SQL['read']['ids'], [ids], prepare=True)
+                    subinfnames[stream] = dict(zip([row[subnode.dbpkname] for row in subrows], subnode._infnames(subrows)))
+
+        digests = []
+        for row in rows:
+            hashstr = str()
+            for stream in self.infname_fields:
+                cfval = row.get(self.stream_db_mapping[stream])
+                if self.is_oagnode(stream):
+                    hashstr += subinfnames[stream].get(cfval, str(None))
+                elif self.is_enum(stream) and cfval is not None:
+                    hashstr += str(self.oagschema.streams[stream][0](cfval))
+                else:
+                    hashstr += str(cfval)
+            digests.append(hashlib.sha256(hashstr.encode('utf-8')).hexdigest())
+
+        return digests
 
     @property
     def infname_semantic(self):
@@ -217,13 +363,54 @@ class OAG_RootNode(object):
 
         return oagcopy
 
-    def reset(self, idxreset=True):
+    def reset(self, idxreset=True, keepstream=False):
+        # Rewinding a stream releases its cursor; iterating again searches
+        # from the start
+        if idxreset and not keepstream:
+            self.rdf.stream_close()
         self.rdf._rdf_window = self.rdf._rdf
+        if self.rdf._rdf_sortkeys and self.rdf._rdf is not None:
+            cframe = self.props._cframe
+            self.rdf.sort(*self.rdf._rdf_sortkeys)
+            self.props._cframe = cframe
         if idxreset:
             self._iteridx = 0
         self.props._set_attrs_from_cframe()
         return self
 
+    def rows(self, streams=None):
+        """Iterate over the current window as read-only named tuples holding
+        id and the given streams (all streams by default). Enums are
+        translated; subnodes are given as ids rather than dereferenced. No
+        attributes, oagprops, cache entries or RPC registrations are created
+        along the way, so this is the fast path for scanning a loaded OAG."""
+        schema  = self.oagschema
+        streams = tuple(streams) if streams else tuple(schema.streams)
+
+        invalid_streams = [s for s in streams if s not in schema.kinds]
+        if len(invalid_streams)>0:
+            raise OAGraphIntegrityError("Invalid row stream(s) detected %s" % invalid_streams)
+
+        rowcls = schema.rowclass(self.__class__, streams)
+
+        pkname  = self.dbpkname
+        columns = [(self.stream_db_mapping[s], self.oagschema.streams[s][0] if self.is_enum(s) else None) for s in streams]
+        mkrow   = rowcls._make
+
+        # Exhausted streams are implicitly refreshed
+        if self.db.is_streaming and not self.rdf.is_streaming:
+            self.db.search(throw_on_empty_local=False)
+
+        while True:
+            for frame in (self.rdf._rdf_window or []):
+                yield mkrow([frame.get(pkname)] + [
+                    frame.get(column) if enumcls is None or frame.get(column) is None else enumcls(frame.get(column))
+                    for (column, enumcls) in columns
+                ])
+
+            if not self.rdf.stream_advance():
+                break
+
     @property
     def size(self):
         if self.rdf._rdf_window is None:
@@ -244,26 +431,33 @@ class OAG_RootNode(object):
         if not self.is_reversible:
             return
 
+        # Nor would its proxies have been set up if __init__ failed part
+        # way. Going through self.rpc would then end up in __getattr__.
+        rpc = self.__dict__.get('_rpc_proxy')
+        if rpc is None:
+            return
+
         oalog.debug(f"GC=========>", f='gc')
-        oalog.debug("Deleting {} {}, {}, proxy: {}".format(
-                self,
-                self.rpc.id if self.rpc.is_enabled else str(),
-                self.rpc.url if self.rpc.is_enabled else str(),
-                self.rpc.is_proxy
-            ), f='gc')
+        if oalog.is_debug('gc'):
+            oalog.debug("Deleting {} {}, {}, proxy: {}".format(
+                    self,
+                    rpc.id if rpc.is_init else str(),
+                    rpc.url if rpc.is_init else str(),
+                    rpc.is_proxy
+                ), f='gc')
 
-        if self.rpc.is_enabled:
+        if rpc.is_enabled:
 
             # Tell upstream proxies that we are going away
 
-            if self.rpc.is_proxy:
+            if rpc.is_proxy:
                 oalog.debug(f"Delete: proxies", f='gc')
-                oalog.debug(f"--> {self.rpc.proxied_url}", f='gc')
-                oactx.rm_ka_via_rpc(self.rpc.url, self.rpc.proxied_url, 'proxy')
+                oalog.debug(f"--> {rpc.proxied_url}", f='gc')
+                oactx.rm_ka_via_rpc(rpc.url, rpc.proxied_url, 'proxy')
 
             # Tell upstream registrations that we are going away
             oalog.debug(f"Delete: registrations", f='gc')
-            oalog.debug(f"--> {self.rpc.registrations}", f='gc')
+            oalog.debug(f"--> {rpc.registrations}", f='gc')
 
             # Tell subnodes we are going away
             oalog.debug(f"Delete cache", f='gc')
@@ -286,8 +480,22 @@ class OAG_RootNode(object):
 
         self.rpc.discoverable = False
 
-    def __getattribute__(self, attr):
-        """Cascade through the following lookups:
+    def __getattr__(self, attr):
+        """Streams without a descriptor on the class (reverse foreign keys)
+        are looked up in the property manager"""
+        try:
+            props = object.__getattribute__(self, '_prop_proxy')
+        except AttributeError:
+            raise AttributeError(attr)
+
+        if not props.is_managed_oagprop(attr):
+            props.add_fkstream(attr)
+
+        return props.get(attr, internal_call=True)
+
+    def _proxy_getattribute(self, attr):
+        """__getattribute__ of proxy OAGs. Cascade through the following
+        lookups:
 
         1. Attempt a lookup via the prop proxy
         2. Attempt to retrieve via RPC if applicable.
@@ -308,9 +516,9 @@ class OAG_RootNode(object):
                     payload = reqcls(self).getstream(rpc.proxied_url, attr)['payload']
                     if payload['value']:
                         if payload['type'] == 'redirect':
-                            for cls in OAG_RootNode.__subclasses__():
-                                if cls.__name__==payload['class']:
-                                    return cls(initurl=payload['value'])
+                            cls = OAG_RootNode.graphclass(payload['class'])
+                            if cls:
+                                return cls(initurl=payload['value'])
                         else:
                             return payload['value']
                 else:
@@ -320,6 +528,31 @@ class OAG_RootNode(object):
 
         return object.__getattribute__(self, attr)
 
+    @classmethod
+    def proxyclass(cls):
+        """Subclass instantiated for OAGs proxying a remote OAG: only these
+        pay for the RPC aware __getattribute__"""
+        if cls.__dict__.get('__getattribute__') is OAG_RootNode._proxy_getattribute:
+            return cls
+
+        if '_proxyclass' not in cls.__dict__:
+            cls._proxyclass = type(cls.__name__, (cls,), {
+                '__getattribute__' : OAG_RootNode._proxy_getattribute,
+                '__module__'       : cls.__module__,
+                '__qualname__'     : cls.__qualname__,
+            }, proxy=True)
+        return cls._proxyclass
+
+    @classmethod
+    def streamprops(cls):
+        """Install a streamprop descriptor on the class for every stream and
+        the primary key. This can't happen when the class is defined, since
+        streams may refer to OAG classes defined further down a module."""
+        if '_streamprops' not in cls.__dict__:
+            for stream in [cls.dbpkname]+list(cls.oagschema.streams.keys()):
+                setattr(cls, stream, streamprop(stream))
+            cls._streamprops = True
+
     def __getitem__(self, indexinfo, preserve_cache=False):
         self.rdf._rdf_window_index = indexinfo
 
@@ -332,7 +565,7 @@ class OAG_RootNode(object):
         if type(self.rdf._rdf_window_index)==int:
             self.props._cframe = self.rdf._rdf_window[self.rdf._rdf_window_index]
         elif type(self.rdf._rdf_window_index)==slice:
-            self.rdf._rdf_window = self.rdf._rdf_window[self.rdf._rdf_window_index]
+            self.rdf.slice(self.rdf._rdf_window_index)
             self.props._cframe = self.rdf._rdf_window[0]
 
         self.props._set_attrs_from_cframe()
@@ -346,6 +579,12 @@ class OAG_RootNode(object):
             subclasses += subclass.__graphsubclasses__()
         return subclasses
 
+    def __new__(cls, *args, initurl=None, **kwargs):
+        cls.streamprops()
+        if initurl is not None:
+            cls = cls.proxyclass()
+        return super().__new__(cls)
+
     def __init__(
                  self,
                  # Implied positional args
@@ -364,7 +603,10 @@ class OAG_RootNode(object):
                  rpc=True,
                  rpc_acl=RpcACL.LOCAL_ALL,
                  rpc_dbupdate_listen=False,
-                 rpc_discovery_timeout=0):
+                 rpc_discovery_timeout=0,
+                 stream=False,
+                 itersize=None,
+                 searchorder=None):
 
         # Initialize environment
         oainit(oag=self)
@@ -376,7 +618,7 @@ class OAG_RootNode(object):
         #### Set up proxies
 
         # Database API
-        self._db_proxy       = DbProxy(self, searchprms, searchidx, searchwin, searchoffset, searchdesc, initschema, throw_on_empty)
+        self._db_proxy       = DbProxy(self, searchprms, searchidx, searchwin, searchoffset, searchdesc, initschema, throw_on_empty, stream, itersize, searchorder)
 
         # Relational Dataframe manipulation
         self._rdf_proxy      = RdfProxy(self)
@@ -408,22 +650,30 @@ class OAG_RootNode(object):
         else:
             self._rpc_proxy.proxied_streams = reqcls(self).register_proxy(self._rpc_proxy.proxied_url, 'proxy')['payload']
 
-        oalog.debug("Create {}, {}, {}".format(
-                self,
-                self.rpc.id if self.rpc.is_enabled else str(),
-                f"listening on {self.rpc.url}" if self.rpc.is_enabled else str()
-            ), f='gc')
+        if oalog.is_debug('gc'):
+            oalog.debug("Create {}, {}, {}".format(
+                    self,
+                    self.rpc.id if self.rpc.is_init else str(),
+                    f"listening on {self.rpc.url}" if self.rpc.is_init else str()
+                ), f='gc')
 
     def __iter__(self):
         if self.is_unique:
             raise OAError("__iter__: Unique OAGraph object is not iterable")
         else:
+            # Exhausted streams are implicitly refreshed
+            if self.db.is_streaming and not self.rdf.is_streaming and self._iteridx==0:
+                self.db.search(throw_on_empty_local=False)
             return self
 
     def __next__(self):
         if self.is_unique:
             raise OAError("__next__: Unique OAGraph object is not iterable")
         else:
+            # Streaming OAGs pull the next chunk once the current one is done
+            if self._iteridx >= self.size and self.rdf.stream_advance():
+                self._iteridx = 0
+
             if self._iteridx < self.size:
 
                 # Clear propcache
@@ -465,11 +715,11 @@ class OAG_RootNode(object):
             super(OAG_RootNode, self).__setattr__(attr, newval)
 
 class OAG_RpcDiscoverable(OAG_RootNode):
-    @property
-    def is_unique(self): return False
+    @staticproperty
+    def is_unique(cls): return False
 
-    @property
-    def context(self): return "openarc"
+    @staticproperty
+    def context(cls): return "openarc"
 
     @staticproperty
     def dbindices(cls):
@@ -1,5 +1,10 @@
+import bisect
 import collections
+import collections.abc
 import copy
+import datetime
+import enum
+import operator
 import weakref
 
 from ._env  import oactx, oalog
@@ -16,9 +21,12 @@ class CacheProxy(object):
         self._oagcache ={}
 
     def clear(self):
-        for stream, oag in self._oagcache.items():
-            if self._oag.is_oagnode(stream):
-                oactx.rm_ka_via_rpc(self._oag.rpc.url, oag.rpc.url, stream)
+        # Only OAGs that have been handed a url can have registered with
+        # their subnodes
+        if len(self._oagcache)>0 and self._oag.rpc.is_init:
+            for stream, oag in self._oagcache.items():
+                if self._oag.is_oagnode(stream) and oag.rpc.is_init:
+                    oactx.rm_ka_via_rpc(self._oag.rpc.url, oag.rpc.url, stream)
         self._oagcache = {}
 
     def clone(self, src):
@@ -26,12 +34,16 @@ class CacheProxy(object):
 
     def invalidate(self, invstream):
         # - filter out calcs: they can no longer be trusted as node as been invalidated
-        tmpoagcache = {oag:self._oagcache[oag] for oag in self._oagcache if oag in self._oag.streams.keys()}
+        tmpoagcache = {oag:self._oagcache[oag] for oag in self._oagcache if oag in self._oag.oagschema.streams.keys()}
         # - filter out invalidated downstream node
         tmpoagcache = {oag:tmpoagcache[oag] for oag in tmpoagcache if oag != invstream}
 
         self._oagcache = tmpoagcache
 
+        # Subnode may have changed underneath infname
+        if invstream in self._oag.oagschema.infname_streams:
+            self._oag.props._infname = None
+
     def match(self, stream):
         return self._oagcache[stream]
 
@@ -45,6 +57,522 @@ class CacheProxy(object):
 
         return self._oagcache
 
+class RdfColumn(object):
+    """A single column of a ColumnarRdf. Integers, floats and booleans are
+    held in typed NumPy arrays (with a null mask only if the column has
+    nulls), timestamps as datetime64[us] normalized to UTC, and text is
+    dictionary encoded: an int32 code per row into a shared list of labels,
+    with index mapping each label back to its code. Anything else is kept in
+    an object array."""
+    __slots__ = ('kind', 'data', 'mask', 'labels', 'index', 'codes', 'tz')
+
+    dtypes = {
+        'bool'  : 'bool',
+        'float' : 'float64',
+        'int'   : 'int64',
+    }
+
+    def __init__(self, kind, data, mask=None, labels=None, index=None, codes=None, tz=None):
+        self.kind   = kind
+        self.data   = data
+        self.mask   = mask
+        self.labels = labels
+        self.index  = index
+        self.codes  = codes
+        self.tz     = tz
+
+    @classmethod
+    def from_values(cls, values):
+        np = _numpy()
+
+        present = [v for v in values if v is not None]
+        types   = set([type(v) for v in present])
+
+        kind = 'object'
+        if len(present)>0:
+            if types == {bool}:
+                kind = 'bool'
+            elif types == {int}:
+                kind = 'int'
+            elif types <= {int, float}:
+                kind = 'float'
+            elif types == {str}:
+                kind = 'text'
+            elif types == {datetime.datetime}\
+                and len(set([v.tzinfo is None for v in present])) == 1:
+                kind = 'time'
+
+        if kind == 'text':
+            labels = []
+            index  = {}
+            codes  = np.empty(len(values), dtype='int32')
+            for i, v in enumerate(values):
+                if v is None:
+                    codes[i] = -1
+                    continue
+                code = index.get(v)
+                if code is None:
+                    code = index[v] = len(labels)
+                    labels.append(v)
+                codes[i] = code
+            return cls(kind, None, labels=labels, index=index, codes=codes)
+
+        if kind == 'time':
+            tz = present[0].tzinfo
+            data = np.array([cls.utc(v) if v is not None else None for v in values], dtype='datetime64[us]')
+            return cls(kind, data, tz=tz)
+
+        if kind in cls.dtypes:
+            mask = None
+            if len(present)<len(values):
+                mask = np.array([v is None for v in values], dtype='bool')
+            try:
+                data = np.array([v if v is not None else 0 for v in values], dtype=cls.dtypes[kind])
+                return cls(kind, data, mask=mask)
+            except OverflowError:
+                pass
+
+        return cls('object', cls.objects(values))
+
+    @staticmethod
+    def objects(values):
+        # Fill element by element so that sequence values (arrays, json)
+        # aren't broadcast by NumPy
+        data = _numpy().empty(len(values), dtype='object')
+        for i, v in enumerate(values):
+            data[i] = v
+        return data
+
+    @staticmethod
+    def utc(value):
+        if value.tzinfo is None:
+            return value
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    def __len__(self):
+        return len(self.codes if self.kind == 'text' else self.data)
+
+    def get(self, idx):
+        if self.kind == 'text':
+            code = self.codes[idx]
+            return self.labels[code] if code>=0 else None
+
+        if self.mask is not None and self.mask[idx]:
+            return None
+
+        value = self.data[idx]
+        if self.kind == 'object':
+            return value
+
+        if self.kind == 'time':
+            if _numpy().isnat(value):
+                return None
+            value = value.item()
+            if self.tz is not None:
+                value = value.replace(tzinfo=datetime.timezone.utc).astimezone(self.tz)
+            return value
+
+        return value.item()
+
+    def set(self, idx, value):
+        if not self.accepts(value):
+            self.promote()
+
+        if self.kind == 'text':
+            if value is None:
+                self.codes[idx] = -1
+            else:
+                code = self.index.get(value)
+                if code is None:
+                    code = self.index[value] = len(self.labels)
+                    self.labels.append(value)
+                self.codes[idx] = code
+        elif self.kind == 'time':
+            self.data[idx] = self.utc(value) if value is not None else None
+        elif self.kind == 'object':
+            self.data[idx] = value
+        else:
+            if value is None:
+                if self.mask is None:
+                    self.mask = _numpy().zeros(len(self.data), dtype='bool')
+                self.mask[idx] = True
+            else:
+                self.data[idx] = value
+                if self.mask is not None:
+                    self.mask[idx] = False
+
+    def accepts(self, value):
+        if value is None or self.kind == 'object':
+            return True
+        if self.kind == 'text':
+            return type(value) == str
+        if self.kind == 'time':
+            return type(value) == datetime.datetime and (value.tzinfo is None) == (self.tz is None)
+        if self.kind == 'bool':
+            return type(value) == bool
+        if self.kind == 'float':
+            return type(value) in [int, float]
+        return type(value) == int and -2**63 <= value < 2**63
+
+    def promote(self):
+        """Fall back to an object array when a value doesn't fit the column"""
+        values = [self.get(i) for i in range(len(self))]
+        self.kind   = 'object'
+        self.data   = self.objects(values)
+        self.mask   = None
+        self.labels = None
+        self.index  = None
+        self.codes  = None
+        self.tz     = None
+
+    def sortkey(self):
+        """Array whose order matches the order of the column's values, or None
+        if the column can't be sorted natively"""
+        np = _numpy()
+        if self.kind == 'text':
+            rank = np.empty(len(self.labels)+1, dtype='int32')
+            rank[sorted(range(len(self.labels)), key=self.labels.__getitem__)] = np.arange(len(self.labels))
+            rank[-1] = len(self.labels)
+            return rank[self.codes]
+        if self.kind == 'time':
+            return self.data
+        if self.kind == 'object' or self.mask is not None:
+            return None
+        return self.data
+
+    def compare(self, op, value):
+        """Boolean array of the rows whose value satisfies op(row value,
+        value). Nulls never match, as in SQL."""
+        np = _numpy()
+
+        if self.kind == 'text':
+            matches = np.array([op(label, value) for label in self.labels] + [False], dtype='bool')
+            return matches[self.codes]
+
+        if self.kind == 'object':
+            return np.array([v is not None and op(v, value) for v in self.data], dtype='bool')
+
+        if op == RdfWhere.contains:
+            value = [v for v in value if v is not None]
+
+        if self.kind == 'time':
+            if op == RdfWhere.contains:
+                value = [self.utc(v) for v in value]
+            else:
+                value = self.utc(value)
+            present = ~np.isnat(self.data)
+        else:
+            present = ~self.mask if self.mask is not None else True
+
+        if op == RdfWhere.contains:
+            # Probes keep their own type: casting them to the column's dtype
+            # would truncate 1.5 to 1 on an int column
+            matches = np.isin(self.data, np.array(value)) if len(value)>0 else np.zeros(len(self.data), dtype='bool')
+        else:
+            matches = op(self.data, value)
+
+        return matches & present
+
+    def slice(self, sl):
+        return RdfColumn(self.kind,
+                         self.data[sl] if self.data is not None else None,
+                         mask=self.mask[sl] if self.mask is not None else None,
+                         labels=self.labels,
+                         index=self.index,
+                         codes=self.codes[sl] if self.codes is not None else None,
+                         tz=self.tz)
+
+    def take(self, order):
+        if self.data is not None:
+            self.data = self.data[order]
+        if self.mask is not None:
+            self.mask = self.mask[order]
+        if self.codes is not None:
+            self.codes = self.codes[order]
+
+class RdfRow(collections.abc.MutableMapping):
+    """Row view into a ColumnarRdf; reads and writes go to the columns"""
+    __slots__ = ('_frame', '_idx')
+
+    def __init__(self, frame, idx):
+        self._frame = frame
+        self._idx   = idx
+
+    def __getitem__(self, key):
+        return self._frame._columns[key].get(self._idx)
+
+    def __setitem__(self, key, value):
+        if key not in self._frame._columns:
+            self._frame._columns[key] = RdfColumn.from_values([None]*len(self._frame))
+        self._frame._columns[key].set(self._idx, value)
+
+    def __delitem__(self, key):
+        raise OAError("Cannot remove columns from a columnar RDF row")
+
+    def __iter__(self):
+        return iter(self._frame._columns)
+
+    def __len__(self):
+        return len(self._frame._columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+class ColumnarRdf(collections.abc.Sequence):
+    """Relational data frame stored one typed array per column instead of
+    one dict per row. Behaves like the list of rows it replaces: indexing
+    returns RdfRow views, slicing returns a ColumnarRdf sharing the
+    underlying arrays."""
+    def __init__(self, rows=[], columns=None):
+        if columns is None:
+            names   = list(rows[0].keys()) if len(rows)>0 else []
+            columns = collections.OrderedDict([(name, RdfColumn.from_values([row[name] for row in rows])) for name in names])
+        self._columns = columns
+
+    def __len__(self):
+        for column in self._columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return ColumnarRdf(columns=collections.OrderedDict([(name, column.slice(idx)) for name, column in self._columns.items()]))
+
+        size = len(self)
+        if idx<0:
+            idx += size
+        if idx<0 or idx>=size:
+            raise IndexError("ColumnarRdf index out of range")
+
+        return RdfRow(self, idx)
+
+    @property
+    def columns(self):
+        return list(self._columns.keys())
+
+    def sort(self, key=None, reverse=False):
+        """Sort rows in place, like list.sort. key is passed row views."""
+        order = sorted(range(len(self)), key=lambda i: key(self[i]) if key else i, reverse=reverse)
+        self.take(order)
+
+    def argsort(self, orderkey):
+        """Row indices ordering the frame by orderkey, a list of (column,
+        descending) pairs, most significant first"""
+        np = _numpy()
+
+        order = np.arange(len(self))
+        if len(order)==0:
+            return order
+
+        for (name, desc) in reversed(orderkey):
+            sortkey = self._columns[name].sortkey()
+            if sortkey is None:
+                values = [self._columns[name].get(i) for i in order]
+                perm = sorted(range(len(order)), key=lambda i: _nullslast(values[i]), reverse=desc)
+                order = order[perm]
+                continue
+
+            sortkey = sortkey[order]
+            if desc:
+                # Negated dense ranks keep the sort stable
+                sortkey = -np.unique(sortkey, return_inverse=True)[1]
+            order = order[np.argsort(sortkey, kind='stable')]
+
+        return order
+
+    def take(self, order):
+        """Reorder rows to the given sequence of row indices"""
+        for column in self._columns.values():
+            column.take(order)
+
+class RdfView(collections.abc.Sequence):
+    """Rows of an RDF in the order of a sequence of row indices. Rows are
+    not copied, so any number of views can share one RDF."""
+    def __init__(self, base, indices):
+        self._base    = base
+        self._indices = indices
+
+    def position(self, idx):
+        """Position in the underlying RDF of row idx of the view"""
+        return int(self._indices[idx])
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return RdfView(self._base, self._indices[idx])
+        return self._base[int(self._indices[idx])]
+
+class RdfIndex(object):
+    """In-memory index from the values of one RDF column to the positions
+    of the rows holding them. Hash indexes answer equality lookups in O(1);
+    sorted indexes answer equality and range lookups in O(log n)."""
+    kinds = ['hash', 'sorted']
+
+    def __init__(self, kind, column):
+        if kind not in self.kinds:
+            raise OAError("Unknown RDF index type [%s]" % kind)
+
+        self.kind    = kind
+        self.column  = column
+
+        # RDF version the index was built against
+        self.version = None
+
+        self._map    = {}
+        self._keys   = []
+        self._rows   = []
+
+    def build(self, rdf, version):
+        values = [row.get(self.column) for row in rdf] if rdf else []
+
+        if self.kind == 'hash':
+            self._map = {}
+            for i, value in enumerate(values):
+                self._map.setdefault(value, []).append(i)
+        else:
+            pairs = sorted([(value, i) for i, value in enumerate(values) if value is not None])
+            self._keys = [value for (value, i) in pairs]
+            self._rows = [i for (value, i) in pairs]
+
+        self.version = version
+
+    def between(self, lo=None, hi=None):
+        """Positions of rows with lo <= value <= hi; either bound may be
+        left open"""
+        if self.kind != 'sorted':
+            raise OAError("Range lookups need a sorted index on [%s]" % self.column)
+
+        start = bisect.bisect_left(self._keys, lo) if lo is not None else 0
+        end   = bisect.bisect_right(self._keys, hi) if hi is not None else len(self._keys)
+
+        return sorted(self._rows[start:end])
+
+    def lookup(self, value):
+        """Positions of rows holding value"""
+        if self.kind == 'hash':
+            return self._map.get(value, [])
+
+        return self.between(value, value)
+
+class RdfWhere(object):
+    """Declarative filter: a conjunction of conditions on streams, written
+    as keyword arguments of the form <stream>[__<op>]=value, e.g.
+    where(price__gt=100, ticker__in=['A', 'B']). Compiles to SQL so it can
+    be pushed into a search, and evaluates directly against RDF rows
+    otherwise."""
+
+    @staticmethod
+    def contains(a, b): return a in b
+
+    ops = {
+        'eq' : ('=',  operator.eq),
+        'ne' : ('<>', operator.ne),
+        'gt' : ('>',  operator.gt),
+        'ge' : ('>=', operator.ge),
+        'lt' : ('<',  operator.lt),
+        'le' : ('<=', operator.le),
+        'in' : ('=',  contains.__func__),
+    }
+
+    def __init__(self, oag, conditions):
+        if len(conditions)==0:
+            raise OAError("where: no conditions given")
+
+        self.terms = []
+        for condition in sorted(conditions):
+            (stream, _, op) = condition.partition('__')
+            op = op if op else 'eq'
+
+            if op not in self.ops:
+                raise OAError("where: unknown operator [%s]" % op)
+
+            if stream != 'id' and stream not in oag.oagschema.streams:
+                raise OAGraphIntegrityError("where: invalid stream [%s]" % stream)
+            column = _dbcolumn(oag, stream)
+
+            value = conditions[condition]
+            if op == 'in':
+                value = [_dbval(v) for v in value]
+            else:
+                value = _dbval(value)
+
+            self.terms.append((column, op, value))
+
+    def __call__(self, oag):
+        return self.match(oag.props._cframe)
+
+    def match(self, row):
+        for (column, op, value) in self.terms:
+            rowval = row.get(column)
+            if rowval is None or not self.ops[op][1](rowval, value):
+                return False
+        return True
+
+    def positions(self, rdf):
+        """Positions of the rows of rdf satisfying every condition"""
+        if isinstance(rdf, ColumnarRdf):
+            if len(rdf)==0:
+                return []
+            matches = True
+            for (column, op, value) in self.terms:
+                matches = rdf._columns[column].compare(self.ops[op][1], value) & matches
+            return _numpy().flatnonzero(matches)
+
+        return [i for i, row in enumerate(rdf) if self.match(row)]
+
+    def scan(self, rdf):
+        """Rows of rdf satisfying every condition"""
+        return [rdf[int(i)] for i in self.positions(rdf)]
+
+    def sql(self):
+        """WHERE clause fragment and its parameters"""
+        clauses = []
+        params  = []
+        for (column, op, value) in self.terms:
+            if op == 'in':
+                clauses.append(f"{column}=ANY(%s)")
+            else:
+                clauses.append(f"{column}{self.ops[op][0]}%s")
+            params.append(value)
+        return (' AND '.join(clauses), params)
+
+def _dbcolumn(oag, stream):
+    # Column backing a stream in the RDF; unknown names are taken to be
+    # columns already
+    if stream == 'id':
+        return oag.dbpkname
+    if stream in oag.oagschema.streams:
+        return oag.stream_db_mapping[stream]
+    return stream
+
+def _dbval(value):
+    # Value as stored in the RDF: subnodes by id, enums by value
+    from ._graph import OAG_RootNode
+    if isinstance(value, OAG_RootNode):
+        return value.id
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+def _nullslast(value):
+    # Sort key placing nulls after values, as postgres does for ascending
+    # sorts (and before them for descending sorts)
+    return (value is None, value)
+
+def _numpy():
+    """NumPy is only needed by the columnar RDF backend, so only import it
+    when that backend is used"""
+    try:
+        import numpy
+    except ImportError:
+        raise OAError("Columnar RDF backend requires numpy")
+    return numpy
+
 class RdfProxy(object):
     """Responsible for manipulation of relational data frame"""
     def __init__(self, oag):
@@ -59,14 +587,38 @@ class RdfProxy(object):
         # If this is a slice, it can be used to further filter the rdf
         self._rdf_window_index = 0
 
+        # Keys the window is sorted by, kept across searches
+        self._rdf_sortkeys = ()
+
         # After
         self._rdf_window = None
 
+        # Source of further chunks of _rdf when streaming from the database,
+        # and the filters the database already applied to them
+        self._rdf_stream = None
+        self._rdf_stream_pushdown = []
+
+        # In-memory indexes by stream, rebuilt on lookup once the RDF has
+        # changed since they were built
+        self._rdf_indices = {}
+        self._rdf_version = 0
+
+        # Is the RDF shared with clones? If so, it is copied before the
+        # first row is patched.
+        self._rdf_shared  = False
+
+        # Positions of the rows copied since the RDF stopped being shared;
+        # None if every row belongs to this OAG
+        self._rdf_private = None
+
     def clone(self, src):
-        self._rdf        = list(src.rdf._rdf)
-        self._rdf_window = list(src.rdf._rdf_window)
+        # Share the RDF and window; either side copies on write
+        self._rdf        = src.rdf._rdf
+        self._rdf_window = src.rdf._rdf_window
         self._rdf_window_index =\
                                 src.rdf._rdf_window_index
+        self._rdf_sortkeys = src.rdf._rdf_sortkeys
+        self._rdf_shared = src.rdf._rdf_shared = self._rdf is not None
         # self._rdf_filter_cache =\
         #                         list(src.rdf._rdf_filter_cache)
 
@@ -77,24 +629,35 @@ class RdfProxy(object):
         if oag.is_unique:
             raise OAError("Cannot filter OAG that is marked unique")
 
-        oag.rdf._rdf_window = oag.rdf._rdf
+        rdf = oag.rdf._rdf
+        oag.rdf._rdf_window = rdf
 
         if rerun is False:
             oag.rdf._rdf_filter_cache.append(predicate)
 
-        oag.rdf._rdf_window = []
-        for i, frame in enumerate(self._rdf):
-            oag.props._cframe = frame
-            oag.cache.clear()
-            oag.props._set_attrs_from_cframe()
-            if predicate(oag):
-                oag.rdf._rdf_window.append(oag.rdf._rdf[i])
-            oag.cache.clear()
+        if isinstance(predicate, RdfWhere):
+            # Declarative filters only need the raw rows
+            positions = predicate.positions(rdf)
+        else:
+            positions = []
+            for i, frame in enumerate(rdf):
+                oag.props._cframe = frame
+                oag.cache.clear()
+                oag.props._set_attrs_from_cframe()
+                if predicate(oag):
+                    positions.append(i)
+                oag.cache.clear()
+
+        # Window is a view over the filtered OAG's RDF, in sorted order if
+        # the OAG has been sorted
+        if oag.rdf._rdf_sortkeys:
+            members   = set(positions)
+            positions = [i for i in oag.rdf.argsort(*oag.rdf._rdf_sortkeys) if int(i) in members]
+        oag.rdf._rdf_window = RdfView(rdf, positions)
 
         if len(oag.rdf._rdf_window)>0:
             oag.props._cframe = oag.rdf._rdf_window[0]
         else:
-            oag.rdf._rdf_window = []
             oag.props._cframe = {}
 
         oag.props._set_attrs_from_cframe()
@@ -118,11 +681,136 @@ class RdfProxy(object):
 
         return ret_list
 
+    @property
+    def is_columnar(self):
+        return isinstance(self._rdf, ColumnarRdf)
+
+    @property
+    def is_streaming(self):
+        """More chunks of the RDF can still be pulled from the database"""
+        return self._rdf_stream is not None
+
+    def load(self, rows):
+        """Replace the RDF with rows read from the database, stored as the
+        OAG's rdfbackend dictates"""
+        if self._oag.rdfbackend == 'columnar':
+            rows = ColumnarRdf(rows)
+        elif self._oag.rdfbackend != 'rows':
+            raise OAError("Unknown RDF backend [%s]" % self._oag.rdfbackend)
+
+        self._rdf = rows
+        self._rdf_window = self._rdf
+        self._rdf_shared = False
+        self._rdf_private = None
+        self.invalidate()
+
+    def patch(self, position, values):
+        """Update the row at position in the RDF with values, and return it.
+        If the RDF is shared with clones, the row list (and for columnar
+        RDFs, the columns) is copied first, and rows are copied as they are
+        patched: the change is only seen by this OAG."""
+        if self._rdf_shared:
+            self.__unshare()
+
+        if self._rdf_private is not None and position not in self._rdf_private:
+            row = self._rdf[position]
+            self._rdf[position] = dict(row)
+            self._rdf_private.add(position)
+            if self._oag.props._cframe is row:
+                self._oag.props._cframe = self._rdf[position]
+
+        row = self._rdf[position]
+        row.update(values)
+        self.invalidate()
+
+        return row
+
+    def patch_current(self, row, values):
+        """patch() the RDF row that row was read from, found by identity or
+        else by primary key. Rows that are not part of the RDF are copied
+        rather than updated in place, since they may be shared with
+        clones."""
+        position = self.rowposition(row)
+        if position is not None:
+            return self.patch(position, values)
+
+        row = dict(row)
+        row.update(values)
+        self.invalidate()
+
+        return row
+
+    def rowposition(self, row):
+        """Position in the RDF of row, or None if it isn't in the RDF"""
+        rdf = self._rdf
+        if rdf is None:
+            return None
+
+        if isinstance(row, RdfRow):
+            if row._frame is rdf:
+                return row._idx
+        else:
+            for i, frame in enumerate(rdf):
+                if frame is row:
+                    return i
+
+        pkname = self._oag.dbpkname
+        pkval  = row.get(pkname)
+        if pkval is not None:
+            for i, frame in enumerate(rdf):
+                if frame.get(pkname)==pkval:
+                    return i
+
+        return None
+
+    def position(self, idx):
+        """Position in the RDF of row idx of the window"""
+        if isinstance(self._rdf_window, RdfView):
+            return self._rdf_window.position(idx)
+
+        return idx if idx>=0 else len(self._rdf_window)+idx
+
+    def slice(self, sl):
+        """Narrow the window to a slice of itself; rows are not copied"""
+        window = self._rdf_window
+        if not isinstance(window, RdfView):
+            window = RdfView(window, range(len(window)))
+        self._rdf_window = window[sl]
+
+        return self._oag
+
+    def __unshare(self):
+        # Take a private copy of the RDF, and point the window and current
+        # row at it
+        rdf = self._rdf
+        if self.is_columnar:
+            self._rdf = copy.deepcopy(rdf)
+            self._rdf_private = None
+        else:
+            self._rdf = list(rdf)
+            self._rdf_private = set()
+        self._rdf_shared = False
+
+        window = self._rdf_window
+        if window is rdf:
+            self._rdf_window = self._rdf
+        elif isinstance(window, RdfView) and window._base is rdf:
+            self._rdf_window = RdfView(self._rdf, window._indices)
+
+        cframe = self._oag.props._cframe
+        if isinstance(cframe, RdfRow) and cframe._frame is rdf:
+            self._oag.props._cframe = RdfRow(self._rdf, cframe._idx)
+
     def reset(self):
 
         # Clear RDF
+        self.stream_close()
+        self.invalidate()
         self._rdf = None
+        self._rdf_shared = False
+        self._rdf_private = None
         self._rdf_filter_cache = []
+        self._rdf_sortkeys = ()
         self._rdf_window_index = 0
         self._rdf_window = None
 
@@ -134,15 +822,161 @@ class RdfProxy(object):
 
         return self._oag
 
-    def sort(self, key):
+    def reapply(self, skip=[]):
+        """Rerun cached filters, other than those in skip, and the sort over
+        a freshly loaded RDF"""
+        for predicate in self._rdf_filter_cache:
+            if predicate not in skip:
+                self.filter(predicate, cache=True, rerun=True)
 
-        self._rdf.sort(key=lambda x: x[key])
-        self._rdf_window = self._rdf
-        self._rdf_window_index = None
+        if self._rdf_sortkeys:
+            self.sort(*self._rdf_sortkeys)
+
+    def stream_advance(self):
+        """Replace the RDF with the next chunk from the stream, with cached
+        filters and the sort applied to it. Chunks that are filtered out
+        entirely are skipped. Returns False once the stream is exhausted."""
+        if self._rdf_stream is None:
+            return False
+
+        while True:
+            try:
+                self.load(next(self._rdf_stream))
+            except StopIteration:
+                self._rdf_stream = None
+                self._rdf_stream_pushdown = []
+                self.load([])
+                break
+
+            self.reapply(self._rdf_stream_pushdown)
+            if len(self._rdf_window)>0:
+                break
+
+        self._rdf_window_index = 0
+
+        return len(self._rdf_window)>0
+
+    def stream_close(self):
+        """Stop streaming, releasing the database cursor (and connection)
+        the stream holds"""
+        if self._rdf_stream is not None:
+            self._rdf_stream.close()
+            self._rdf_stream = None
+            self._rdf_stream_pushdown = []
+
+    def stream_open(self, chunks, pushdown=[]):
+        """Start streaming RDF from an iterator of row chunks; only the chunk
+        currently being iterated over is held in memory. pushdown are the
+        cached filters the database applies itself."""
+        self.stream_close()
+        self._rdf_stream = chunks
+        self._rdf_stream_pushdown = pushdown
+        self.stream_advance()
+
+    def between(self, stream, lo=None, hi=None):
+        """OAG windowed on the rows with lo <= stream <= hi, found through a
+        sorted index on stream"""
+        return self.__indexed(self.__index(stream, 'sorted').between(_dbval(lo), _dbval(hi)))
+
+    def index(self, stream, kind='hash'):
+        """Declare an in-memory index ('hash' or 'sorted') over stream for
+        lookup() and between(). Classes can declare them in rdfindices."""
+        self._rdf_indices[stream] = RdfIndex(kind, _dbcolumn(self._oag, stream))
+        return self._oag
+
+    def invalidate(self):
+        """Rows of the RDF have changed: indexes have to be rebuilt"""
+        self._rdf_version += 1
+
+    def lookup(self, stream, value):
+        """OAG windowed on the rows whose stream equals value, found through
+        an index on stream. Streams without a declared index get a hash
+        index on first lookup."""
+        return self.__indexed(self.__index(stream).lookup(_dbval(value)))
+
+    def __index(self, stream, kind='hash'):
+        if stream not in self._rdf_indices:
+            self.index(stream, self._oag.rdfindices.get(stream, kind))
+
+        index = self._rdf_indices[stream]
+        if index.version != self._rdf_version:
+            index.build(self._rdf, self._rdf_version)
+
+        return index
+
+    def __indexed(self, positions):
+        oag = self._oag.clone()
+        oag.rdf._rdf_window = RdfView(oag.rdf._rdf, positions)
+
+        if len(positions)>0:
+            oag.props._cframe = oag.rdf._rdf_window[0]
+        else:
+            oag.props._cframe = {}
+        oag.props._set_attrs_from_cframe()
+
+        return oag
+
+    def where(self, **conditions):
+        """Filter on stream conditions, e.g. where(price__gt=100). Supported
+        operators are eq (the default), ne, gt, ge, lt, le and in. If the RDF
+        has not been loaded yet, the conditions are added to the WHERE clause
+        of the next search; otherwise a filtered OAG is returned, as with
+        filter()."""
+        predicate = RdfWhere(self._oag, conditions)
+
+        if self._rdf is None:
+            self._rdf_filter_cache.append(predicate)
+            return self._oag
+
+        return self.filter(predicate)
+
+    def argsort(self, *keys):
+        """Indices of the RDF's rows in sorted order. Keys are streams, or
+        database columns, prefixed with '-' to sort in descending order;
+        nulls sort as in postgres."""
+        orderkey = [(_dbcolumn(self._oag, key.lstrip('-')), key[0]=='-') for key in keys]
+
+        if self.is_columnar:
+            return self._rdf.argsort(orderkey)
+
+        order = list(range(len(self._rdf)))
+        for (column, desc) in reversed(orderkey):
+            order.sort(key=lambda i: _nullslast(self._rdf[i][column]), reverse=desc)
+
+        return order
+
+    def sort(self, *keys):
+        """Order the window by one or more keys (see argsort). Rows are not
+        moved: the window becomes a sorted view over the RDF. The order is
+        reapplied when the OAG searches again."""
+        order = self.argsort(*keys)
+        if isinstance(self._rdf_window, RdfView):
+            members = set(int(i) for i in self._rdf_window._indices)
+            order = [i for i in order if int(i) in members]
+
+        self._rdf_window = RdfView(self._rdf, order)
+        self._rdf_sortkeys = keys
+        self._rdf_window_index = 0
         self._oag.props._cframe = {}
 
         return self._oag
 
+    def find(self, pkval):
+        """Position in the window of the row with primary key pkval, or None
+        if it isn't in the window"""
+        pkname = self._oag.dbpkname
+        for i, row in enumerate(self._rdf_window or []):
+            if row.get(pkname)==pkval:
+                return i
+        return None
+
+    def sorted(self, *keys):
+        """Sorted view of the RDF as a new OAG, sharing rows with this one"""
+        oag = self._oag.clone()
+        oag.rdf.sort(*keys)
+
+        return oag
+
 class PropProxy(object):
     """Manipulates properties"""
     def __init__(self, oag):
@@ -157,7 +991,13 @@ class PropProxy(object):
         self._oagprops      = {}
 
         # Streams that are managed by this property manager
-        self._managed_oagprops = []
+        self._managed_oagprops = set()
+
+        # Streams modified since cframe was last loaded or flushed
+        self._dirty         = set()
+
+        # infname of the OAG, memoized as (cframe, digest)
+        self._infname       = None
 
     def add(self, stream, cfval, cfcls, searchidx, from_cframe, from_foreign_key, fastiter):
         """Add new cfval to the property management dict. If cfval is an
@@ -267,7 +1107,11 @@ class PropProxy(object):
 
                     if gen_retval:
                         try:
-                            attr = streaminfo(searchprms, searchidx, searchwin, searchoffset, searchdesc)
+                            prefetched = obj.db._prefetched.get(stream, {})
+                            if not from_foreign_key and newval in prefetched:
+                                attr = streaminfo(searchidx=searchidx).db._preload(searchprms, [prefetched[newval]])
+                            else:
+                                attr = streaminfo(searchprms, searchidx, searchwin, searchoffset, searchdesc)
                             retval = attr[-1] if not attr.is_unique else attr
                         except OAGraphRetrieveError:
                             retval  = None
@@ -291,17 +1135,27 @@ class PropProxy(object):
             cfval_prop = oagprop(fget)
         else:
             if is_enum:
-                cfval_prop = self._oag.streams[stream][0](cfval)
+                cfval_prop = self._oag.oagschema.streams[stream][0](cfval)
             else:
                 cfval_prop = cfval
 
         self._oagprops[stream] = cfval_prop
 
+        if stream in self._oag.oagschema.infname_streams:
+            self._infname = None
+
+        #
+        # Track streams that have been changed since the last load
+        #
+        if not from_cframe and stream in self._oag.oagschema.streams:
+            if fastiter or currval is None or currval != cfval:
+                self._dirty.add(stream)
+
         #
         # Carry out inter-OAG signalling, but only if we are not in fast iteration
         # mode
         #
-        if not fastiter and self._oag.rpc.is_enabled and self._oag.rpc.is_init and stream not in self._oag.rpc.stoplist:
+        if not fastiter and self._oag.rpc.is_enabled and not self._oag.rpc.is_stopped(stream):
 
             if not from_cframe:
 
@@ -334,23 +1188,26 @@ class PropProxy(object):
                             for addr, stream_to_invalidate in self._oag.rpc.registrations.items():
                                 reqcls(self._oag).invalidate(addr, stream_to_invalidate)
 
+    def clean(self):
+        """Mark all streams as being in sync with the datastore"""
+        self._dirty = set()
+
     def clear(self):
         for stream in self._oagprops:
             self._oagprops[stream] = None
+        self.clean()
 
     def clone(self, src):
         self._cframe = dict(src.props._cframe)
 
+    @property
+    def dirty(self):
+        """Streams modified since cframe was last loaded or flushed"""
+        return self._dirty
+
     def get(self, stream, searchwin=None, searchoffset=None, searchdesc=False, internal_call=False):
         try:
             if self.is_managed_oagprop(stream):
-                # Set default value on class
-                try:
-                    attr = object.__getattribute__(self._oag, stream)
-                except AttributeError:
-                    setattr(self._oag.__class__, stream, None)
-
-                # Return it
                 if type(self._oagprops[stream])==oagprop:
                     # Ok, a bit of fuckery here: if there is a searchwin/offset defined, we don't want to
                     # poison the original version which should always return the original, non-windowed
@@ -368,18 +1225,34 @@ class PropProxy(object):
     def is_managed_oagprop(self, stream):
         """Takes requested attribute and returns True or false"""
         if len(self._managed_oagprops)==0:
-            self._managed_oagprops = list(set(
+            self._managed_oagprops = set(
                 [object.__getattribute__(self._oag, 'dbpkname')] +\
-                list(object.__getattribute__(self._oag, 'streams').keys())
-            ))
+                list(object.__getattribute__(self._oag, 'oagschema').streams.keys())
+            )
         return stream in self._managed_oagprops
 
     def register_managed_oagprop(self, stream):
-        self._managed_oagprops.append(stream)
-        list(set(self._managed_oagprops))
+        self._managed_oagprops.add(stream)
+
+    def add_fkstream(self, stream):
+        """Add stream if it is generated for a foreign key pointing at the
+        OAG, using the current row, or the first row of the window if none
+        has been selected yet"""
+        for (fkstream, cfcls, points_to_id, searchidx) in type(self._oag).fkstreams:
+            if fkstream != stream:
+                continue
+
+            cframe = self._cframe
+            window = self._oag.rdf._rdf_window
+            if len(cframe)==0 and window:
+                cframe = window[0]
+            self.add(stream, cframe.get(points_to_id), cfcls, searchidx, True, True, False)
+            return
 
     def _set_attrs_from_cframe(self, fastiter=False, nofk=False):
-        from ._graph import OAG_RootNode
+
+        # Attributes are about to reflect cframe exactly
+        self.clean()
 
         # Blank everything if _cframe isn't set
         if len(self._cframe)==0:
@@ -396,25 +1269,27 @@ class PropProxy(object):
 
             # Translate stream name and add to prop proxy
             stream = self._oag.db_stream_mapping[stream]
-            self.add(stream, cfval, self._oag.streams[stream][0], 'id', True, False, fastiter)
+            self.add(stream, cfval, self._oag.oagschema.streams[stream][0], 'id', True, False, fastiter)
 
         # Set forward lookup attributes -- but only if nofk flag is set
         if nofk:
             return
-        for i, fk in enumerate(self._oag.__class__._fkframe):
-            classname = oactx.db_class_mapping(fk['table'])
-            for cfcls in OAG_RootNode.__graphsubclasses__():
-
-                if cfcls.__name__==classname:
-
-                    # Generate name of new stream
-                    stream = fk['table']
-                    if len([f for f in self._oag.__class__._fkframe if f['table']==fk['table']])>1:
-                        stream+='_'+cfcls.db_stream_mapping[fk['id']]
-
-                    cfval = getattr(self._oag, fk['points_to_id'], None)
-                    searchidx = 'by_'+cfcls.db_stream_mapping[fk['id']]
-                    self.add(stream, cfval, cfcls, searchidx, True, True, fastiter)
+        fkstreams = type(self._oag).fkstreams
+
+        # Forget streams of foreign keys that have since gone away. Foreign
+        # keys added since are picked up by add_fkstream() on first read.
+        stale = self._managed_oagprops\
+                - set(self._oag.oagschema.streams)\
+                - {self._oag.dbpkname}\
+                - {fkstream[0] for fkstream in fkstreams}
+        for stream in stale:
+            self._managed_oagprops.discard(stream)
+            self._oagprops.pop(stream, None)
+            self._oag.cache.state.pop(stream, None)
+
+        for (stream, cfcls, points_to_id, searchidx) in fkstreams:
+            cfval = getattr(self._oag, points_to_id, None)
+            self.add(stream, cfval, cfcls, searchidx, True, True, fastiter)
 
     def _set_attrs_from_cframe_uniq(self):
         if len(self._oag.rdf._rdf_window) > 1:
@@ -457,13 +1332,14 @@ class PropProxy(object):
                     rdf.append(datarow)
                 self._oag.rdf._rdf = rdf
                 self._oag.rdf._rdf_window = self._oag.rdf._rdf
+                self._oag.rdf.invalidate()
                 self._oag.reset()
 
             invalid_streams = []
             processed_streams = {}
 
             if len(userprms)>0:
-                invalid_streams = [ s for s in userprms if s not in self._oag.streams.keys() ]
+                invalid_streams = [ s for s in userprms if s not in self._oag.oagschema.streams.keys() ]
                 if len(invalid_streams)>0:
                     raise OAGraphIntegrityError("Invalid update stream(s) detected %s" % invalid_streams)
 
@@ -475,7 +1351,7 @@ class PropProxy(object):
         cframe_tmp = {}
         raw_missing_streams = []
 
-        all_streams = list(self._oag.streams.keys())
+        all_streams = list(self._oag.oagschema.streams.keys())
         if len(self._cframe) > 0:
             all_streams.append(self._oag.dbpkname)
 
@@ -492,8 +1368,8 @@ class PropProxy(object):
             cfval = getattr(self._oag, stream, None)
 
             # Special handling for nullable items.
-            if type(self._oag.streams[stream][0])!=str\
-                and self._oag.streams[stream][1] is False:
+            if type(self._oag.oagschema.streams[stream][0])!=str\
+                and self._oag.oagschema.streams[stream][1] is False:
                 cframe_tmp[cfkey] = (cfval.id if self._oag.is_oagnode(stream) else cfval.value) if cfval else None
                 continue
 
@@ -521,7 +1397,7 @@ class PropProxy(object):
                 if self._oag.is_oagnode(rms):
                     missing_streams.append(rms)
                 else:
-                    if self._oag.streams[rms][1] is not None:
+                    if self._oag.oagschema.streams[rms][1] is not None:
                         missing_streams.append(rms)
             if len(missing_streams)>0:
                 raise OAGraphIntegrityError("Missing streams detected on [%s]: %s" % (self._oag.dbtable, missing_streams))
@@ -223,8 +223,8 @@ class OARpc_RTR_Requests(OARpc):
 
         # Execute any event handlers
         try:
-            if invstream in oag.streams.keys():
-                evhdlr = oag.streams[invstream][2]
+            if invstream in oag.oagschema.streams.keys():
+                evhdlr = oag.oagschema.streams[invstream][2]
                 if evhdlr:
                     getattr(oag, evhdlr, None)()
         except KeyError as e:
@@ -238,10 +238,11 @@ class OARpc_RTR_Requests(OARpc):
     def proc_register_proxy(self, oag, ret, args):
         oag.rpc.registration_add(args['addr'], args['stream'])
 
-        rawprops = list(oag.streams.keys())\
+        rawprops = list(oag.oagschema.streams.keys())\
                    + [p for p in dir(oag.__class__) if isinstance(getattr(oag.__class__, p), property)]\
                    + [p for p in dir(oag.__class__) if isinstance(getattr(oag.__class__, p), oagprop)]\
-                   + list(oag.props._oagprops.keys())
+                   + list(oag.props._oagprops.keys())\
+                   + [fkstream[0] for fkstream in type(oag).fkstreams]
 
         ret['payload'] = [p for p in list(set(rawprops)) if p not in oag.rpc.stoplist]
 
@@ -391,10 +392,11 @@ class RpcProxy(object):
         ### Store reference to OAG
         self._oag = weakref.ref(oag)
 
-        ### Spin up rpc infrastructure
+        ### Spin up rpc infrastructure. The id, the stoplist and the router
+        ### registration are only set up once something needs them.
 
         # A unique identifier for this OAG's rpc infra
-        self._rpc_id = base64.b16encode(os.urandom(5)).decode('utf-8')
+        self._rpc_id = None
 
         # Is RPC initialization complete?
         self._rpc_init_done = False
@@ -424,15 +426,7 @@ class RpcProxy(object):
         self._rpc_transaction = RpcTransaction(self)
 
         # Stoplist of OAG streams that shouldn't be exposed over RPC
-        self._rpc_stop_list = [
-            'cache',
-            'db',
-            'discoverable',
-            'logger',
-            'props',
-            'rdf',
-            'rpc',
-        ] + [attr for attr in dir(self._oag) if attr[0]=='_']
+        self._rpc_stop_list = None
 
         ### Set up OAG proxying infrastructure
 
@@ -455,8 +449,7 @@ class RpcProxy(object):
         if self._proxy_url:
             self._proxy_mode = True
 
-        # Register OAG with router
-        self._rpc_init_done = oactx.rpcrtr.register_oag(self._rpc_id, self._oag)
+        # OAG is registered with router when its url is first requested
 
     def __getattribute__(self, attrname):
         attr = object.__getattribute__(self, attrname)
@@ -547,7 +540,10 @@ class RpcProxy(object):
     def fanout(self): return False
 
     @property
-    def id(self): return self._rpc_id
+    def id(self):
+        if self._rpc_id is None:
+            self._rpc_id = base64.b16encode(os.urandom(5)).decode('utf-8')
+        return self._rpc_id
 
     @property
     def is_enabled(self):
@@ -610,8 +606,25 @@ class RpcProxy(object):
             oalog.debug(f"[{self.id}] Starting heartbeat greenlet at [{datetime.datetime.now().isoformat()}]", f='rpc')
             oactx.put_glet(self, gevent.spawn(self.__cb_heartbeat), glet_type='heartbeat')
 
+    # OAG attributes that are never exposed over RPC, besides private ones
+    stop_attrs = frozenset([
+        'cache',
+        'db',
+        'discoverable',
+        'logger',
+        'props',
+        'rdf',
+        'rpc',
+    ])
+
+    def is_stopped(self, attr):
+        """Is attr kept from being exposed over RPC?"""
+        return attr[0]=='_' or attr in RpcProxy.stop_attrs
+
     @property
     def stoplist(self):
+        if self._rpc_stop_list is None:
+            self._rpc_stop_list = sorted(RpcProxy.stop_attrs) + [attr for attr in dir(self._oag) if attr[0]=='_']
         return self._rpc_stop_list
 
     @property
@@ -620,6 +633,9 @@ class RpcProxy(object):
 
     @property
     def url(self):
+        # Handing out the url makes OAG reachable: register it with router
+        if self._rpc_enabled and not self._rpc_init_done:
+            self._rpc_init_done = oactx.rpcrtr.register_oag(self.id, self._oag)
         return '%s/%s' % (oactx.rpcrtr.addr, self.id)
 
     def __cb_heartbeat(self):
@@ -1,4 +1,4 @@
-__all__ = ['oagprop', 'staticproperty']
+__all__ = ['oagprop', 'staticproperty', 'streamprop']
 
 class oagprop(object):
     """Responsible for maitaining _oagcache on decorated properties"""
@@ -23,7 +23,7 @@ class oagprop(object):
             subnode = self.fget(obj, searchwin=searchwin, searchoffset=searchoffset, searchdesc=searchdesc)
             if subnode is not None:
                 from ._graph import OAG_RootNode
-                if isinstance(subnode, OAG_RootNode):
+                if isinstance(subnode, OAG_RootNode) and obj.rpc.is_enabled:
                     from ._rpc import reqcls
                     reqcls(obj).register(subnode.rpc.url, self.fget.__name__)
                 if cache:
@@ -35,4 +35,24 @@ class oagprop(object):
 
 class staticproperty(property):
     def __get__(self, cls, owner):
-        return classmethod(self.fget).__get__(None, owner)()
\ No newline at end of file
+        return classmethod(self.fget).__get__(None, owner)()
+
+class streamprop(object):
+    """Data descriptor for a stream of an OAG class, reading it from the
+    OAG's property manager. Values set before the property manager exists
+    are kept in the instance dict."""
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return obj._prop_proxy.get(self.name, internal_call=True)
+        except AttributeError:
+            return obj.__dict__.get(self.name)
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
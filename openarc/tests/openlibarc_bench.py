@@ -0,0 +1,160 @@
+import datetime
+import sys
+import time
+import tracemalloc
+import unittest
+
+sys.path.append('../')
+
+from test              import TestOABase
+
+from openarc           import *
+from openarc._db       import DbProxy
+from openarc._rdf      import ColumnarRdf
+from openarc.exception import *
+
+class TestOABench(unittest.TestCase, TestOABase):
+    """Microbenchmarks for hot paths. Run with `make bench`; timings are
+    printed, not asserted."""
+    def setUp(self):
+        self.setUp_db()
+
+    def tearDown(self):
+        self.tearDown_db()
+
+    def bench(self, label, fn, iterations=1000):
+        start = time.perf_counter()
+        for i in range(iterations):
+            fn()
+        elapsed = time.perf_counter()-start
+        print(f"\n{label:<50} {iterations:>7} iter {elapsed*1000000/iterations:>10.1f} us/iter")
+        return elapsed
+
+    def bench_memory(self, label, fn):
+        tracemalloc.start()
+        try:
+            result = fn()
+            (allocated, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        print(f"\n{label:<50} {allocated/1024:>10.1f} KiB {peak/1024:>10.1f} KiB peak")
+        return (result, allocated)
+
+    def test_rdf_memory(self):
+        """Memory held by an RDF of 100k rows as a list of dicts (rows
+        backend) against one array per column (columnar backend)"""
+        now = datetime.datetime.now()
+
+        def rows():
+            return [{
+                '_bench_node_id' : i,
+                'field1'         : i,
+                'field2'         : i%2,
+                'field3'         : 'bench%d' % (i%10),
+                'field4'         : now,
+            } for i in range(100000)]
+
+        (rdf, rows_bytes) = self.bench_memory("RDF 100k rows: list of dicts", rows)
+        (_, columnar_bytes) = self.bench_memory("RDF 100k rows: columnar", lambda: ColumnarRdf(rdf))
+        self.assertLess(columnar_bytes, rows_bytes)
+
+    def test_search_sql_catalog(self):
+        """search() with the SQL catalog rebuilt on every access (previous
+        behavior) against the compiled per-class catalog"""
+        for i in range(10):
+            OAG_BenchNode().db.create({
+                'field1' : i,
+                'field2' : i%2,
+                'field3' : 'bench',
+            })
+
+        node = OAG_BenchNode(1, 'by_f2_idx')
+
+        def search_cold():
+            DbProxy._sql_catalog = {}
+            node.db.search()
+
+        def search_warm():
+            node.db.search()
+
+        self.bench("search(): catalog rebuilt per call", search_cold)
+        self.bench("search(): compiled catalog", search_warm)
+        self.assertEqual(node.size, 5)
+
+        def sql_cold():
+            DbProxy._sql_catalog = {}
+            node.db.SQL
+
+        self.bench("DbProxy.SQL: rebuilt", sql_cold, iterations=10000)
+        self.bench("DbProxy.SQL: compiled", lambda: node.db.SQL, iterations=10000)
+
+    def test_rows(self):
+        """Iterating over an OAG against scanning it with rows()"""
+        OAG_BenchNode(initprms=[
+            ['field1', 'field2', 'field3'],
+        ] + [[i, 3, 'rows'] for i in range(1000)]).db.create_many()
+
+        node = OAG_BenchNode(3, 'by_f2_idx')
+
+        self.bench("OAG iteration, 1000 rows", lambda: [oa.field1 for oa in node], iterations=10)
+        self.bench("rows(), 1000 rows", lambda: [row.field1 for row in node.rows()], iterations=10)
+
+    def test_stream_reads(self):
+        """Reads of streams (hits) and of attributes that aren't set on the
+        OAG (misses)"""
+        node = OAG_BenchNode().db.create({
+            'field1' : 1,
+            'field2' : 2,
+            'field3' : 'reads',
+        })
+
+        self.bench("node.stream (hit)", lambda: node.field1, iterations=100000)
+        self.bench("node.id (hit)", lambda: node.id, iterations=100000)
+        self.bench("getattr(node, missing) (miss)", lambda: getattr(node, 'missing', None), iterations=100000)
+
+    def test_construction(self):
+        """Construction of plain OAGs, which don't set up RPC until their url
+        is needed, and dereference of a subnode stream"""
+        node = OAG_BenchNode().db.create({
+            'field1' : 1,
+            'field2' : 2,
+            'field3' : 'construction',
+        })
+        subnode = OAG_BenchSubNode().db.create({
+            'field1' : 1,
+            'node'   : node,
+        })
+
+        def dereference():
+            subnode.cache.clear()
+            return subnode.node
+
+        self.bench("OAG_BenchNode()", lambda: OAG_BenchNode(), iterations=10000)
+        self.bench("subnode.node (uncached)", dereference)
+
+class OAG_BenchNode(OAG_RootNode):
+    @staticproperty
+    def context(cls): return "test"
+
+    @staticproperty
+    def dbindices(cls) : return {
+        'f1_idx' : [['field1'], False, None ],
+        'f2_idx' : [['field2'], False, None ],
+    }
+
+    @staticproperty
+    def streams(cls): return {
+        'field1'   : [ 'int',         0, None ],
+        'field2'   : [ 'int',         0, None ],
+        'field3'   : [ 'varchar(50)', 0, None ],
+    }
+
+class OAG_BenchSubNode(OAG_RootNode):
+    @staticproperty
+    def context(cls): return "test"
+
+    @staticproperty
+    def streams(cls): return {
+        'field1'   : [ 'int',         0,    None ],
+        'node'     : [ OAG_BenchNode, True, None ],
+    }
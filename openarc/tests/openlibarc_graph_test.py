@@ -1,4 +1,5 @@
 import base64
+import datetime
 import enum
 import gevent
 import openarc
@@ -6,6 +7,8 @@ import os
 import sys
 import unittest
 
+from time              import monotonic
+
 sys.path.append('../')
 
 from test              import TestOABase
@@ -252,6 +255,32 @@ class TestOAGraphRootNode(unittest.TestCase, TestOABase):
             nmi.field5 = 'infname_morph_test'
             self.assertEqual(infname, nmi.infname)
 
+    def test_multinode_infname_memo(self):
+        """infname is memoized until an infname stream changes, and can be
+        calculated for every row in one batch"""
+        a8 = OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 23, 'infname memo'] for i in range(3)]).db.create_many()
+        for i in range(3):
+            OAG_AutoNode16().db.create({'field1' : 23, 'subnode8' : a8[i]})
+
+        a16 = OAG_AutoNode16(23, 'by_f1_idx')
+        infnames = [oa.infname for oa in a16]
+        self.assertEqual(len(set(infnames)), 3)
+        self.assertEqual(a16.infnames(), infnames)
+
+        infname = a16[0].infname
+        self.assertTrue(a16.props._infname[0] is a16.props._cframe)
+        self.assertEqual(a16.infname, infname)
+
+        # Subnode invalidation drops memoized infname
+        a16.cache.invalidate('subnode8')
+        self.assertEqual(a16.props._infname, None)
+        self.assertEqual(a16.infname, infname)
+
+        a16.field1 = 24
+        self.assertNotEqual(a16.infname, infname)
+
     def test_autonode_retrieval_styles(self):
         """Graph retrieval succeeds with no tuple"""
         (a1, a2, a3) = self.__generate_autonode_system()
@@ -417,6 +446,42 @@ class TestOAGraphRootNode(unittest.TestCase, TestOABase):
         # self.__check_autonode_equivalence(a1a[1].subnode1, a2b)
         self.__check_autonode_equivalence(a1a[1].subnode2, a3)
 
+    def test_autonode_create_many(self):
+        """Bulk initialized OAGs are persisted in one round trip regardless of
+        row count, and primary keys are backfilled into the RDF"""
+        from openarc._env import oactx
+
+        def create_many(field4, rows):
+            a8 =\
+                OAG_AutoNode8(initprms=[
+                    ['field3', 'field4', 'field5'],
+                ] + [[i, field4, 'create many'] for i in range(rows)])
+            roundtrips = oactx.db_pool.roundtrips
+            a8.db.create_many()
+            return (a8, oactx.db_pool.roundtrips-roundtrips)
+
+        # Warm up schema
+        create_many(5, 1)
+
+        (a8_small, roundtrips_small) = create_many(6, 5)
+        (a8, roundtrips) = create_many(7, 50)
+        self.assertEqual(roundtrips, roundtrips_small)
+
+        self.assertEqual(a8.size, 50)
+        self.assertEqual(len(set([oa.id for oa in a8])), 50)
+        self.assertTrue(None not in [oa.id for oa in a8])
+
+        a8_chk = OAG_AutoNode8(7, 'by_f4_idx')
+        self.assertEqual([oa.id for oa in a8_chk], [oa.id for oa in a8])
+        self.assertEqual([oa.field3 for oa in a8_chk], list(range(50)))
+
+        # Each backfilled id belongs to the row it was written from
+        self.assertEqual({oa.id : oa.field3 for oa in a8}, {oa.id : oa.field3 for oa in a8_chk})
+
+        # Materialized rows cannot be created again
+        with self.assertRaises(OAError):
+            a8.db.create_many()
+
     def test_autonode_update_with_userprms(self):
         (a1,   a2,   a3)   = self.__generate_autonode_system()
         (a1_b, a2_b, a3_b) = self.__generate_autonode_system()
@@ -453,6 +518,99 @@ class TestOAGraphRootNode(unittest.TestCase, TestOABase):
         a1_chk =OAG_AutoNode1a(a1.id)[0]
         self.__check_autonode_equivalence(a1_chk.subnode1, a2_b)
 
+    def test_autonode_update_dirty_streams(self):
+        """update() writes only streams changed since the last load, and skips
+        the database entirely if nothing changed"""
+        from openarc._env import oactx
+
+        a8 =\
+            OAG_AutoNode8().db.create({
+                'field3' : 1,
+                'field4' : 2,
+                'field5' : 'dirty test',
+            })
+
+        self.assertEqual(len(a8.props.dirty), 0)
+
+        roundtrips = oactx.db_pool.roundtrips
+        a8.field3 = 1
+        a8.db.update()
+        self.assertEqual(oactx.db_pool.roundtrips, roundtrips)
+
+        # Change made behind OAG's back to a stream it did not touch survives
+        with self.dbconn.cursor() as cur:
+            cur.execute(self.SQL.update_autonode8_field5, ['changed elsewhere', a8.id])
+            self.dbconn.commit()
+
+        a8.field3 = 99
+        self.assertEqual(a8.props.dirty, {'field3'})
+        a8.db.update()
+        self.assertEqual(len(a8.props.dirty), 0)
+
+        a8_chk = OAG_AutoNode8(a8.id)[0]
+        self.assertEqual(a8_chk.field3, 99)
+        self.assertEqual(a8_chk.field5, 'changed elsewhere')
+
+    def test_multinode_batch_update(self):
+        """Updates made while iterating a multinode in a batch are written with
+        a single statement per set of changed columns, and patched into the
+        RDF without a refresh"""
+        from openarc._env import oactx
+
+        for i in range(10):
+            OAG_AutoNode8().db.create({
+                'field3' : i,
+                'field4' : 3,
+                'field5' : 'batch update %d' % i,
+            })
+
+        node_multi = OAG_AutoNode8(3, 'by_f4_idx')
+
+        roundtrips = oactx.db_pool.roundtrips
+        with node_multi.db.batch() as batch:
+            for oa in node_multi:
+                oa.field3 = oa.field3+10
+                oa.db.update()
+            self.assertEqual(batch.size, 10)
+        self.assertEqual(oactx.db_pool.roundtrips-roundtrips, 1)
+
+        self.assertEqual([oa.field3 for oa in node_multi], [i+10 for i in range(10)])
+
+        node_multi_chk = OAG_AutoNode8(3, 'by_f4_idx')
+        self.assertEqual([oa.field3 for oa in node_multi_chk], [i+10 for i in range(10)])
+
+        # Rows are only written to the columns changed on them: a change made
+        # elsewhere to a column a row didn't touch survives the batch
+        with node_multi.db.batch():
+            for oa in node_multi:
+                if oa.field3%2 == 0:
+                    oa.field5 = 'batched'
+                else:
+                    oa.field3 = oa.field3+1
+                oa.db.update()
+            with self.dbconn.cursor() as cur:
+                cur.execute(self.SQL.update_autonode8_field5, ['changed elsewhere', node_multi_chk[1].id])
+                self.dbconn.commit()
+
+        node_multi_chk = OAG_AutoNode8(3, 'by_f4_idx')
+        self.assertEqual([oa.field3 for oa in node_multi_chk], [i+10 if i%2==0 else i+11 for i in range(10)])
+        self.assertEqual([oa.field5 for oa in node_multi_chk],
+                         ['batched' if i%2==0 else 'batch update %d' % i for i in range(10)][:1]
+                         + ['changed elsewhere']
+                         + ['batched' if i%2==0 else 'batch update %d' % i for i in range(10)][2:])
+
+        # If the batch can't be written, the RDF is put back as it was
+        with self.assertRaises(OAGraphStorageError):
+            with node_multi.db.batch():
+                for oa in node_multi:
+                    oa.field5 = 'unwritten'
+                    oa.field3 = 'not a number' if oa.field3==20 else oa.field3+1
+                    oa.db.update()
+        self.assertEqual([oa.field3 for oa in node_multi], [i+10 if i%2==0 else i+11 for i in range(10)])
+        self.assertEqual([oa.field5 for oa in node_multi],
+                         ['batched' if i%2==0 else 'batch update %d' % i for i in range(10)])
+        self.assertEqual([oa.field5 for oa in OAG_AutoNode8(3, 'by_f4_idx')][1], 'changed elsewhere')
+
     def test_autonode_fwdoag_creation(self):
 
         a2 =\
@@ -1870,6 +2028,543 @@ class TestOAGraphRootNode(unittest.TestCase, TestOABase):
         a8_b = OAG_AutoNode8(0, "by_f4_idx", throw_on_empty=False)
         self.assertEqual(a8_b.size, 0)
 
+    def test_autonode_search_roundtrips(self):
+        """Searches outside a transaction should send exactly one statement to
+        the database"""
+        from openarc._env import oactx
+
+        for i in range(3):
+            OAG_AutoNode8().db.create({
+                'field3' : i,
+                'field4' : 2,
+                'field5' : 'roundtrip test',
+            })
+
+        node_multi = OAG_AutoNode8(2, 'by_f4_idx')
+
+        roundtrips = oactx.db_pool.roundtrips
+        node_multi.db.search()
+        self.assertEqual(oactx.db_pool.roundtrips-roundtrips, 1)
+        self.assertEqual(node_multi.size, 3)
+
+    def test_autonode_cooperative_search(self):
+        """Slow searches in separate greenlets should run concurrently instead
+        of blocking the gevent hub"""
+        OAG_AutoNode14().db.create({'field1' : 1})
+
+        def slow_search():
+            return OAG_AutoNode14([0.5, 1], 'by_slow_f1').size
+
+        start = monotonic()
+        glets = [gevent.spawn(slow_search) for i in range(2)]
+        gevent.joinall(glets, raise_error=True)
+        elapsed = monotonic()-start
+
+        self.assertEqual([g.value for g in glets], [1, 1])
+        self.assertLess(elapsed, 0.9)
+
+    def test_autonode_stream_search(self):
+        """Streaming OAGs iterate over every row while holding no more than
+        itersize rows in memory"""
+        OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 9, 'stream'] for i in range(10)]).db.create_many()
+
+        a8 = OAG_AutoNode8(9, 'by_f4_idx', stream=True, itersize=3)
+        self.assertTrue(a8.db.is_streaming)
+
+        seen = []
+        for oa in a8:
+            self.assertLessEqual(a8.size, 3)
+            seen.append(oa.field3)
+        self.assertEqual(seen, list(range(10)))
+
+        # Exhausted streams are searched again on next iteration
+        self.assertEqual([oa.field3 for oa in a8], list(range(10)))
+
+        # Cached filters and the sort apply to every chunk; chunks filtered
+        # out entirely are skipped
+        a8_filtered = OAG_AutoNode8(9, 'by_f4_idx', stream=True, itersize=3)
+        a8_filtered.rdf.filter(lambda oa: oa.field3%2==0, cache=True)
+        a8_filtered.rdf.sort('-field3')
+        self.assertEqual([oa.field3 for oa in a8_filtered], [2, 0, 4, 8, 6])
+
+        # Streams abandoned part way release their connection on reset
+        from openarc._env import oactx
+        idle = oactx.db_pool.idle
+        for oa in a8:
+            break
+        self.assertEqual(oactx.db_pool.idle, idle-1)
+        a8.reset()
+        self.assertEqual(oactx.db_pool.idle, idle)
+        self.assertEqual([oa.field3 for oa in a8], list(range(10)))
+
+        # Unique OAGs cannot be streamed
+        with self.assertRaises(OAError):
+            OAG_AutoNode5(stream=True)
+
+    def test_autonode_keyset_pagination(self):
+        """next_page() walks a windowed search by primary key in either
+        direction"""
+        OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 11, 'paged'] for i in range(10)]).db.create_many()
+
+        a8 = OAG_AutoNode8(11, 'by_f4_idx', searchwin=4)
+        pages = [[oa.field3 for oa in a8]]
+        pages.append([oa.field3 for oa in a8.db.next_page()])
+        pages.append([oa.field3 for oa in a8.db.next_page()])
+        self.assertEqual(pages, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        with self.assertRaises(OAGraphRetrieveError):
+            a8.db.next_page()
+
+        a8_desc = OAG_AutoNode8(11, 'by_f4_idx', searchwin=4, searchdesc=True)
+        a8_desc.db.next_page()
+        self.assertEqual([oa.field3 for oa in a8_desc], [5, 4, 3, 2])
+
+        # Searching again goes back to the first page
+        a8.db.search()
+        self.assertEqual([oa.field3 for oa in a8], [0, 1, 2, 3])
+        self.assertEqual([oa.field3 for oa in a8.db.next_page()], [4, 5, 6, 7])
+
+        # Windowless searches can't be paginated
+        with self.assertRaises(OAError):
+            OAG_AutoNode8(11, 'by_f4_idx').db.next_page()
+
+        # Rows with NULL sort keys are paged to, last ascending and first
+        # descending
+        now = datetime.datetime(2020, 1, 1)
+        for i in range(5):
+            OAG_AutoNode15().db.create({
+                'field1' : 11,
+                'field2' : 'paged',
+                'field3' : now+datetime.timedelta(days=i%3) if i<3 else None,
+            })
+
+        for order in ['field3', '-field3']:
+            a15 = OAG_AutoNode15(11, 'by_f1_idx', searchwin=2, searchorder=[order])
+            rows = [(oa.field3, oa.id) for oa in a15]
+            while True:
+                try:
+                    rows += [(oa.field3, oa.id) for oa in a15.db.next_page()]
+                except OAGraphRetrieveError:
+                    break
+            ids = [row[1] for row in rows]
+            self.assertEqual(len(ids), 5)
+            self.assertEqual(ids, [oa.id for oa in OAG_AutoNode15(11, 'by_f1_idx', searchorder=[order])])
+            self.assertEqual([row[0] is None for row in rows],
+                             [False]*3+[True]*2 if order=='field3' else [True]*2+[False]*3)
+
+    def test_autonode_columnar_rdf(self):
+        """OAGs with a columnar RDF backend search, iterate, filter, sort and
+        update like row backed OAGs"""
+        from openarc._rdf import ColumnarRdf, RdfColumn
+
+        now = datetime.datetime(2020, 1, 1)
+        for i in range(6):
+            OAG_AutoNode15().db.create({
+                'field1' : 1,
+                'field2' : 'label%d' % (i%2),
+                'field3' : now+datetime.timedelta(days=i) if i!=3 else None,
+            })
+
+        a15 = OAG_AutoNode15(1, 'by_f1_idx')
+        self.assertTrue(isinstance(a15.rdf._rdf, ColumnarRdf))
+        self.assertEqual(a15.size, 6)
+        self.assertEqual([oa.field2 for oa in a15], ['label0', 'label1']*3)
+        self.assertEqual(a15[3].field3, None)
+        self.assertEqual(a15[4].field3, now+datetime.timedelta(days=4))
+
+        a15_flt = a15.rdf.filter(lambda x: x.field2=='label1')
+        self.assertEqual(a15_flt.size, 3)
+
+        a15.rdf.sort('field2')
+        self.assertEqual([oa.field2 for oa in a15], ['label0']*3 + ['label1']*3)
+
+        # Updates follow the row through the sorted view, which survives the
+        # refresh
+        a15[1].db.update({'field2' : 'relabelled'})
+        relabelled_id = a15.id
+        self.assertEqual(a15.field2, 'relabelled')
+        self.assertEqual([oa.field2 for oa in a15], ['label0']*2 + ['label1']*3 + ['relabelled'])
+        self.assertEqual(OAG_AutoNode15(relabelled_id)[0].field2, 'relabelled')
+
+        # Text columns reuse the code of a known label, and append new ones
+        column = RdfColumn.from_values(['label0', None, 'label1'])
+        column.set(1, 'label1')
+        column.set(0, 'label2')
+        self.assertEqual([column.get(i) for i in range(3)], ['label2', 'label1', 'label1'])
+        self.assertEqual(column.labels, ['label0', 'label1', 'label2'])
+
+        # Empty columnar RDFs have no columns to sort or filter on
+        a15_empty = OAG_AutoNode15(2, 'by_f1_idx', throw_on_empty=False)
+        self.assertEqual(a15_empty.rdf.sorted('field2').size, 0)
+        self.assertEqual(a15_empty.rdf.where(field2='label0').size, 0)
+
+        # Membership tests don't cast probes to the column type
+        self.assertEqual(a15.rdf.where(field1__in=[1.5]).size, 0)
+        self.assertEqual(a15.rdf.where(field1__in=[1]).size, 6)
+
+    def test_autonode_where(self):
+        """Declarative filters run against loaded rows, and are pushed into
+        the search when rows haven't been loaded"""
+        OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 12, 'where%d' % (i%3)] for i in range(10)]).db.create_many()
+
+        a8 = OAG_AutoNode8(12, 'by_f4_idx')
+        a8_where = a8.rdf.where(field3__gt=2, field5__in=['where0', 'where1'])
+        self.assertEqual([oa.field3 for oa in a8_where], [3, 4, 6, 7, 9])
+        self.assertEqual(a8.size, 10)
+
+        self.assertEqual(a8.rdf.where(field3=4).size, 1)
+        self.assertEqual(a8.rdf.where(field3__ne=4, field3__le=5).size, 5)
+
+        with self.assertRaises(OAGraphIntegrityError):
+            a8.rdf.where(field9=1)
+        with self.assertRaises(OAError):
+            a8.rdf.where(field3__like=1)
+
+        # Pushed down into the search
+        a8_pushdown = OAG_AutoNode8(searchidx='by_all')
+        a8_pushdown.rdf.where(field4=12, field3__lt=5, field5='where1')
+        a8_pushdown.db.search()
+        self.assertEqual([oa.field3 for oa in a8_pushdown], [1, 4])
+
+    def test_autonode_searchorder(self):
+        """Searches can be ordered by several streams in the database, and
+        loaded RDFs sorted into views without reordering rows"""
+        OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i%3, 13, 'order%d' % (i%2)] for i in range(6)]).db.create_many()
+
+        a8 = OAG_AutoNode8(13, 'by_f4_idx', searchorder=['-field3', 'field5'])
+        self.assertEqual([(oa.field3, oa.field5) for oa in a8], [
+            (2, 'order0'), (2, 'order1'),
+            (1, 'order0'), (1, 'order1'),
+            (0, 'order0'), (0, 'order1'),
+        ])
+
+        with self.assertRaises(OAError):
+            OAG_AutoNode8(13, 'by_f4_idx', searchorder=['field9'])
+
+        # OAGs whose initialization failed are finalized quietly
+        OAG_AutoNode8.__new__(OAG_AutoNode8).__del__()
+
+        # Pages follow the declared order
+        a8_paged = OAG_AutoNode8(13, 'by_f4_idx', searchwin=4, searchorder=['field3'])
+        a8_paged.db.next_page()
+        self.assertEqual([oa.field3 for oa in a8_paged], [2, 2])
+
+        # Sorted views share rows with the OAG they were made from
+        a8 = OAG_AutoNode8(13, 'by_f4_idx')
+        a8_sorted = a8.rdf.sorted('field5', '-field3')
+        self.assertEqual([(oa.field5, oa.field3) for oa in a8_sorted], [
+            ('order0', 2), ('order0', 1), ('order0', 0),
+            ('order1', 2), ('order1', 1), ('order1', 0),
+        ])
+        self.assertEqual([oa.field3 for oa in a8], [0, 1, 2, 0, 1, 2])
+        self.assertTrue(a8_sorted.rdf._rdf is a8.rdf._rdf)
+
+        # Filters and resets keep the sort order
+        self.assertEqual([(oa.field5, oa.field3) for oa in a8_sorted.rdf.where(field3__ge=1)], [
+            ('order0', 2), ('order0', 1), ('order1', 2), ('order1', 1),
+        ])
+        self.assertEqual([oa.field3 for oa in a8_sorted.rdf.filter(lambda oa: oa.field5=='order1')], [2, 1, 0])
+        a8_sorted.reset()
+        self.assertEqual([(oa.field5, oa.field3) for oa in a8_sorted], [
+            ('order0', 2), ('order0', 1), ('order0', 0),
+            ('order1', 2), ('order1', 1), ('order1', 0),
+        ])
+
+    def test_autonode_rdf_indices(self):
+        """Lookups through in-memory indexes find rows of a loaded RDF, and
+        follow changes to it"""
+        OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 14, 'index%d' % (i%3)] for i in range(9)]).db.create_many()
+
+        a8 = OAG_AutoNode8(14, 'by_f4_idx')
+        self.assertEqual([oa.field3 for oa in a8.rdf.lookup('field5', 'index1')], [1, 4, 7])
+        self.assertEqual(a8.rdf.lookup('field5', 'missing').size, 0)
+
+        a8.rdf.index('field3', 'sorted')
+        self.assertEqual([oa.field3 for oa in a8.rdf.between('field3', 3, 5)], [3, 4, 5])
+        self.assertEqual([oa.field3 for oa in a8.rdf.between('field3', lo=7)], [7, 8])
+        with self.assertRaises(OAError):
+            a8.rdf.between('field5', 'index0', 'index1')
+
+        # Indexes are rebuilt after updates and searches
+        a8[0].db.update({'field5' : 'index1'})
+        self.assertEqual([oa.field3 for oa in a8.rdf.lookup('field5', 'index1')], [0, 1, 4, 7])
+
+        OAG_AutoNode8().db.create({'field3' : 9, 'field4' : 14, 'field5' : 'index1'})
+        a8.db.search()
+        self.assertEqual([oa.field3 for oa in a8.rdf.lookup('field5', 'index1')], [0, 1, 4, 7, 9])
+
+    def test_autonode_aggregate(self):
+        """Aggregates are computed by the database, over the searched rows,
+        and returned as columns"""
+        OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 15, 'agg%d' % (i%2)] for i in range(6)]).db.create_many()
+
+        a8 = OAG_AutoNode8(15, 'by_f4_idx')
+        self.assertEqual(a8.db.aggregate(group_by=['field5'], field3=['sum', 'max']), {
+            'field5'     : ['agg0', 'agg1'],
+            'count'      : [3, 3],
+            'field3_max' : [4, 5],
+            'field3_sum' : [6, 9],
+        })
+        self.assertEqual(a8.db.aggregate(where={'field3__gt' : 1}, field3='min'), {
+            'count'      : [4],
+            'field3_min' : [2],
+        })
+
+        with self.assertRaises(OAError):
+            a8.db.aggregate(field3='median')
+        with self.assertRaises(OAGraphIntegrityError):
+            a8.db.aggregate(group_by=['field9'])
+
+    def test_autonode_prefetch(self):
+        """Prefetched subnodes are dereferenced without going to the database
+        for every row"""
+        from openarc._env import oactx
+
+        a8 = OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 16, 'prefetch'] for i in range(3)]).db.create_many()
+
+        for i in range(6):
+            OAG_AutoNode16().db.create({
+                'field1'   : 16,
+                'subnode8' : a8[i%3],
+            })
+
+        a16 = OAG_AutoNode16(16, 'by_f1_idx')
+        roundtrips = oactx.db_pool.roundtrips
+        a16.db.prefetch('subnode8')
+        self.assertEqual(oactx.db_pool.roundtrips-roundtrips, 1)
+
+        roundtrips = oactx.db_pool.roundtrips
+        self.assertEqual([oa.subnode8.field3 for oa in a16], [0, 1, 2, 0, 1, 2])
+        self.assertEqual(oactx.db_pool.roundtrips-roundtrips, 0)
+
+        with self.assertRaises(OAGraphIntegrityError):
+            a16.db.prefetch('field1')
+
+    def test_autonode_class_registry(self):
+        """OAG classes are registered by name and table, and foreign key
+        streams are resolved through the registry"""
+        self.assertEqual(OAG_RootNode.graphclass('OAG_AutoNode8'), OAG_AutoNode8)
+        self.assertEqual(OAG_RootNode.graphclass(table='auto_node8'), OAG_AutoNode8)
+        self.assertEqual(OAG_RootNode.graphclass('OAG_DoesNotExist'), None)
+
+        a8 = OAG_AutoNode8().db.create({'field3' : 1, 'field4' : 17, 'field5' : 'registry'})
+        OAG_AutoNode16().db.create({'field1' : 17, 'subnode8' : a8})
+
+        a8 = OAG_AutoNode8(a8.id)
+        self.assertTrue(('auto_node16', OAG_AutoNode16, '_auto_node8_id', 'by_subnode8') in OAG_AutoNode8.fkstreams)
+        self.assertEqual(a8.auto_node16.field1, 17)
+
+        # Classes whose context is an instance property get their foreign
+        # key streams too
+        a7 = OAG_AutoNode7(initprms={'field1' : True}).db.create()
+        a17 = OAG_AutoNode17().db.create({'subnode7' : a7})
+        self.assertEqual(OAG_AutoNode7(a7.id).auto_node17.id, a17.id)
+
+    def test_autonode_rows(self):
+        """rows() yields read-only tuples straight from the RDF, without
+        dereferencing subnodes or touching the cache"""
+        a8 = OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 18, 'rows'] for i in range(3)]).db.create_many()
+        for i in range(3):
+            OAG_AutoNode16().db.create({'field1' : 18, 'subnode8' : a8[i]})
+
+        a16 = OAG_AutoNode16(18, 'by_f1_idx')
+        rows = list(a16.rows())
+        self.assertEqual([row.subnode8 for row in rows], [oa.id for oa in a8])
+        self.assertEqual([row.field1 for row in rows], [18, 18, 18])
+        self.assertEqual([row.id for row in rows], [oa.id for oa in a16])
+        self.assertEqual(a16.cache.state, {})
+        with self.assertRaises(AttributeError):
+            rows[0].field1 = 19
+        with self.assertRaises(AttributeError):
+            rows[0].field9 = 19
+
+        # The row class is built once per OAG class
+        self.assertIs(type(next(OAG_AutoNode16(18, 'by_f1_idx').rows())), type(rows[0]))
+
+        self.assertEqual(list(a16.rows(['field1']))[0]._fields, ('id', 'field1'))
+        with self.assertRaises(OAGraphIntegrityError):
+            list(a16.rows(['field9']))
+
+        # Enums are translated
+        a13 = OAG_AutoNode13().db.create({'enum' : FriezeEnum.PHASE_3, 'scalar' : 1})
+        self.assertEqual([row.enum for row in OAG_AutoNode13(a13.id).rows()], [FriezeEnum.PHASE_3])
+
+    def test_autonode_stream_descriptors(self):
+        """Streams are read through descriptors installed on the class; only
+        proxy OAGs use the RPC aware __getattribute__"""
+        from openarc._util import streamprop
+
+        a8 = OAG_AutoNode8().db.create({'field3' : 1, 'field4' : 19, 'field5' : 'descriptor'})
+        self.assertTrue(isinstance(OAG_AutoNode8.__dict__['field3'], streamprop))
+        self.assertTrue(isinstance(OAG_AutoNode8.__dict__[OAG_AutoNode8.dbpkname], streamprop))
+        self.assertEqual(a8.field3, 1)
+        self.assertEqual(getattr(a8, 'missing', None), None)
+        with self.assertRaises(AttributeError):
+            a8.missing
+
+        self.assertTrue('__getattribute__' not in OAG_AutoNode8.__dict__)
+        proxycls = OAG_AutoNode8.proxyclass()
+        self.assertTrue(issubclass(proxycls, OAG_AutoNode8))
+        self.assertEqual(proxycls.dbtable, OAG_AutoNode8.dbtable)
+        self.assertEqual(proxycls.proxyclass(), proxycls)
+        self.assertEqual(OAG_RootNode.graphclass('OAG_AutoNode8'), OAG_AutoNode8)
+
+    def test_autonode_lazy_rpc(self):
+        """RPC is only set up once the OAG's url is needed"""
+        a8 = OAG_AutoNode8().db.create({'field3' : 1, 'field4' : 24, 'field5' : 'lazy rpc'})
+        self.assertFalse(a8.rpc.is_init)
+
+        url = a8.url
+        self.assertTrue(a8.rpc.is_init)
+        self.assertTrue(url.endswith('/'+a8.rpc.id))
+        self.assertEqual(a8.url, url)
+        self.assertTrue('_iteridx' in a8.rpc.stoplist)
+        self.assertTrue(a8.rpc.is_stopped('db'))
+        self.assertFalse(a8.rpc.is_stopped('field3'))
+
+        # Disabled RPC is never set up
+        a8_norpc = OAG_AutoNode8(a8.id, rpc=False)
+        self.assertFalse(a8_norpc.rpc.is_init)
+
+    def test_autonode_schema(self):
+        """Class metadata is compiled once into an immutable schema"""
+        schema = OAG_AutoNode16.oagschema
+        self.assertTrue(OAG_AutoNode16.oagschema is schema)
+        self.assertEqual(schema.dbtable, 'auto_node16')
+        self.assertEqual(schema.dbpkname, '_auto_node16_id')
+        self.assertEqual(schema.stream_db_mapping['subnode8'], 'auto_node8_id_subnode8')
+        self.assertEqual(schema.db_stream_mapping['auto_node8_id_subnode8'], 'subnode8')
+        self.assertEqual(list(schema.streams), ['field1', 'subnode8'])
+        self.assertTrue(schema.streams['subnode8'][0] is OAG_AutoNode8)
+        self.assertTrue(OAG_AutoNode16.is_oagnode('subnode8'))
+        self.assertTrue(OAG_AutoNode16.is_scalar('field1'))
+        self.assertTrue(OAG_AutoNode13.is_enum('enum'))
+        self.assertFalse(OAG_AutoNode13.is_enum('scalar'))
+        with self.assertRaises(TypeError):
+            schema.stream_db_mapping['field1'] = 'field2'
+        with self.assertRaises(TypeError):
+            schema.streams['field2'] = ['int', 0, None]
+        with self.assertRaises(AttributeError):
+            schema.dbtable = 'auto_node17'
+
+    def test_schema_bootstrap(self):
+        """Bootstrap creates missing tables in one pass over the catalog, and
+        skips the diff when the schema fingerprint is unchanged"""
+        from openarc._db import DbSchemaProxy
+
+        with self.dbconn.cursor() as cur:
+            cur.execute(self.SQL.drop_schema_fingerprint)
+            self.dbconn.commit()
+
+        oagclasses = [OAG_AutoNode8, OAG_AutoNode16]
+        DbSchemaProxy.bootstrap(oagclasses)
+        with self.dbconn.cursor() as cur:
+            cur.execute(self.SQL.get_table_columns, ['auto_node16'])
+            self.assertEqual(sorted(r[0] for r in cur.fetchall()), ['_auto_node16_id', 'auto_node8_id_subnode8', 'field1'])
+            cur.execute(self.SQL.get_schema_fingerprint)
+            self.assertEqual(cur.fetchall(), [(DbSchemaProxy.fingerprint(oagclasses),)])
+            cur.execute(self.SQL.drop_autonode16)
+            self.dbconn.commit()
+        self.assertEqual([fk['table'] for fk in OAG_AutoNode8._fkframe], ['auto_node16'])
+
+        # Fingerprint is unchanged, so the missing table goes unnoticed
+        DbSchemaProxy.bootstrap(oagclasses)
+        with self.dbconn.cursor() as cur:
+            cur.execute(self.SQL.get_table_columns, ['auto_node16'])
+            self.assertEqual(cur.fetchall(), [])
+            self.dbconn.commit()
+
+        # Schema changes trigger the diff
+        DbSchemaProxy.bootstrap(oagclasses+[OAG_AutoNode13])
+        with self.dbconn.cursor() as cur:
+            cur.execute(self.SQL.get_table_columns, ['auto_node16'])
+            self.assertEqual(len(cur.fetchall()), 3)
+            cur.execute(self.SQL.get_table_columns, ['auto_node13'])
+            self.assertEqual(sorted(r[0] for r in cur.fetchall()), ['_auto_node13_id', 'enum', 'scalar'])
+            self.dbconn.commit()
+
+        # Fingerprints are kept per schema: other schemas leave them alone
+        DbSchemaProxy.bootstrap([OAG_RpcDiscoverable])
+        with self.dbconn.cursor() as cur:
+            cur.execute(self.SQL.get_schema_fingerprint)
+            self.assertEqual(cur.fetchall(), [(DbSchemaProxy.fingerprint(oagclasses+[OAG_AutoNode13]),)])
+            self.dbconn.commit()
+
+    def test_schema_fkeys_catalog(self):
+        """Foreign keys of all classes are read in one query, and only read
+        again after DDL"""
+        from openarc._env import oactx
+
+        a8 = OAG_AutoNode8().db.create({'field3' : 1, 'field4' : 22, 'field5' : 'fkeys'})
+        a16 = OAG_AutoNode16().db.create({'field1' : 22, 'subnode8' : a8})
+        self.assertEqual([(fk['table'], fk['id']) for fk in OAG_AutoNode8._fkframe], [('auto_node16', 'auto_node8_id_subnode8')])
+        self.assertEqual(oactx.db_fkeys_generation, oactx.db_pool.schema_generation)
+
+        roundtrips = oactx.db_pool.roundtrips
+        a16.db.schema.init_fkeys()
+        self.assertEqual(oactx.db_pool.roundtrips, roundtrips)
+        self.assertEqual(a8.auto_node16.id, a16.id)
+
+    def test_autonode_rdf_sharing(self):
+        """Clones, filters and slices are views over one RDF; rows are only
+        copied when patched"""
+        from openarc._rdf import RdfView
+
+        OAG_AutoNode8(initprms=[
+            ['field3', 'field4', 'field5'],
+        ] + [[i, 25, 'sharing'] for i in range(6)]).db.create_many()
+
+        a8 = OAG_AutoNode8(25, 'by_f4_idx')
+        a8_clone = a8.clone()
+        a8_where = a8.rdf.where(field3__ge=3)
+        self.assertIs(a8_clone.rdf._rdf, a8.rdf._rdf)
+        self.assertIs(a8_where.rdf._rdf, a8.rdf._rdf)
+        self.assertIsInstance(a8_where.rdf._rdf_window, RdfView)
+        self.assertEqual([oa.field3 for oa in a8_where], [3, 4, 5])
+
+        a8_slice = a8.clone()[1:3]
+        self.assertIs(a8_slice.rdf._rdf, a8.rdf._rdf)
+        self.assertEqual([oa.field3 for oa in a8_slice], [1, 2])
+
+        # Patching rows through the filter leaves the other OAGs alone
+        with a8_where.db.batch():
+            for oa in a8_where:
+                oa.field3 = oa.field3*10
+                oa.db.update()
+        self.assertEqual([oa.field3 for oa in a8_where], [30, 40, 50])
+        self.assertIsNot(a8_where.rdf._rdf, a8.rdf._rdf)
+        self.assertIs(a8_where.rdf._rdf[0], a8.rdf._rdf[0])
+        self.assertEqual([oa.field3 for oa in a8], list(range(6)))
+        self.assertEqual([oa.field3 for oa in a8_clone], list(range(6)))
+
+        a8_chk = OAG_AutoNode8(25, 'by_f4_idx')
+        self.assertEqual([oa.field3 for oa in a8_chk], [0, 1, 2, 30, 40, 50])
+
+        # Nor does patching the selected row of a slice
+        a8_slice = a8.clone()[1:3]
+        with a8_slice.db.batch():
+            a8_slice.field5 = 'sliced'
+            a8_slice.db.update()
+        self.assertEqual(a8_slice.rdf._rdf[1]['field5'], 'sliced')
+        self.assertEqual([oa.field5 for oa in a8], ['sharing']*6)
+        self.assertEqual([oa.field5 for oa in a8_clone], ['sharing']*6)
+        self.assertEqual([oa.field5 for oa in OAG_AutoNode8(25, 'by_f4_idx')], ['sharing', 'sliced']+['sharing']*4)
+
     class SQL(TestOABase.SQL):
         """Boilerplate SQL needed for rest of class"""
         get_search_path =\
@@ -1880,6 +2575,16 @@ class TestOAGraphRootNode(unittest.TestCase, TestOABase):
             "INSERT INTO test.sample_table( field2, field3 ) VALUES ( %s, %s )"
         get_rows_from_sample_table =\
             "SELECT field2 FROM test.sample_table"
+        update_autonode8_field5 =\
+            "UPDATE test.auto_node8 SET field5=%s WHERE _auto_node8_id=%s"
+        get_table_columns =\
+            "SELECT column_name FROM information_schema.columns WHERE table_schema='test' AND table_name=%s"
+        get_schema_fingerprint =\
+            "SELECT fingerprint FROM openarc.schema_fingerprint WHERE context='test'"
+        drop_schema_fingerprint =\
+            "DROP TABLE IF EXISTS openarc.schema_fingerprint"
+        drop_autonode16 =\
+            "DROP TABLE test.auto_node16"
 
 class OAG_AutoNode1a(OAG_RootNode):
     @staticproperty
@@ -2121,6 +2826,70 @@ class OAG_AutoNode13(OAG_RootNode):
         'scalar' : [ 'int',      True,  None ],
     }
 
+class OAG_AutoNode14(OAG_RootNode):
+    @staticproperty
+    def context(cls): return "test"
+
+    @staticproperty
+    def streams(cls): return {
+        'field1'   : [ 'int', 0, None ],
+    }
+
+    @staticproperty
+    def dblocalsql(cls): return {
+        "read" : {
+          "slow_f1" : """
+              WITH slow AS (SELECT pg_sleep(%s))
+            SELECT t.*
+              FROM {0}.{1} t, slow
+             WHERE t.field1=%s
+          ORDER BY {2}"""
+        }
+    }
+
+class OAG_AutoNode15(OAG_RootNode):
+    @staticproperty
+    def context(cls): return "test"
+
+    @staticproperty
+    def dbindices(cls) : return {
+        'f1_idx' : [['field1'], False, None ],
+    }
+
+    @staticproperty
+    def rdfbackend(cls): return 'columnar'
+
+    @staticproperty
+    def streams(cls): return {
+        'field1'   : [ 'int',         0,    None ],
+        'field2'   : [ 'varchar(50)', 0,    None ],
+        'field3'   : [ 'timestamp',   None, None ],
+    }
+
+class OAG_AutoNode16(OAG_RootNode):
+    @staticproperty
+    def context(cls): return "test"
+
+    @staticproperty
+    def dbindices(cls) : return {
+        'f1_idx' : [['field1'], False, None ],
+    }
+
+    @staticproperty
+    def streams(cls): return {
+        'field1'   : [ 'int',         0,    None ],
+        'subnode8' : [ OAG_AutoNode8, True, None ],
+    }
+
+class OAG_AutoNode17(OAG_RootNode):
+    @staticproperty
+    def context(cls): return "test"
+
+    @staticproperty
+    def streams(cls): return {
+        'subnode7' : [ OAG_AutoNode7, True, None ],
+    }
+
 class OAG_AUTONodeNonReversible(OAG_RootNode):
     @staticproperty
     def context(cls): return "test"
@@ -1,4 +1,6 @@
+import gevent
 import psycopg2
+import psycopg2.extras
 import sys
 import unittest
 
@@ -8,6 +10,7 @@ from test         import TestOABase
 
 from openarc      import *
 from openarc._dao import *
+from openarc.exception import *
 
 class TestOADao(unittest.TestCase, TestOABase):
     def setUp(self):
@@ -30,13 +33,21 @@ class TestOADao(unittest.TestCase, TestOABase):
             self.assertEqual(type(dao_ctx), OADao)
 
     def test_cursor_generation(self):
-        """Property cur on OADao should return cursor with correct search_path"""
+        """Property cur on OADao should return cursor with correct search_path,
+        without issuing setup statements"""
         with OADao("test") as dao:
             # Cursor generation returns dicts
-            self.assertEqual(type(dao.cur).__name__, "RealDictCursor")
-            # Cursor points to correct search_path
+            self.assertIsInstance(dao.cur, psycopg2.extras.RealDictCursor)
+            # No round trips are spent setting up the cursor
+            conn = dao.dbconn
+            roundtrips = conn.roundtrips
+            dao.cur
+            self.assertEqual(conn.roundtrips, roundtrips)
+            # Cursor points to correct search_path; unheld statements are
+            # autocommitted: exactly one round trip
             ret = dao.execute(self.SQL.get_search_path)
             self.assertEqual(ret[0]['search_path'], 'test')
+            self.assertEqual(conn.roundtrips, roundtrips+1)
 
     def test_dao_commit(self):
         """Uncommitted transactions should not show up in database"""
@@ -86,6 +97,67 @@ class TestOADao(unittest.TestCase, TestOABase):
             testcur.execute(self.SQL.get_rows_from_sample_table)
             self.assertEqual(testcur.rowcount, 20)
 
+    def test_connection_pool(self):
+        """Daos check connections out of the pool and return them when done"""
+        from openarc._env import oactx, oaenv
+
+        pool = oactx.db_pool
+
+        # Held daos keep their connection until finalized, and concurrent daos
+        # never share a connection
+        with OADao("test", trans_commit_hold=True) as dao1:
+            dao1.execute(self.SQL.get_search_path)
+            with OADao("test", trans_commit_hold=True) as dao2:
+                dao2.execute(self.SQL.get_search_path)
+                self.assertNotEqual(dao1.dbconn, dao2.dbconn)
+        self.assertEqual(pool.idle, pool.size)
+
+        # Unheld daos return their connection after every statement
+        dao = OADao("test")
+        dao.execute(self.SQL.get_search_path)
+        self.assertEqual(dao._dbconn, None)
+        self.assertEqual(pool.idle, pool.size)
+
+        # Greenlets wait on an exhausted pool instead of overflowing it
+        def hold_connection():
+            with OADao("test", trans_commit_hold=True) as dao:
+                dao.execute(self.SQL.get_search_path)
+                gevent.sleep(0.05)
+
+        glets = [gevent.spawn(hold_connection) for i in range(oaenv.dbinfo.pool_max+2)]
+        gevent.joinall(glets, raise_error=True)
+        self.assertLessEqual(pool.size, oaenv.dbinfo.pool_max)
+        self.assertEqual(pool.idle, pool.size)
+
+        # Checkouts from an exhausted pool give up after the pool timeout
+        conns = [pool.getconn() for i in range(oaenv.dbinfo.pool_max)]
+        timeout, pool._timeout = pool._timeout, 0.05
+        try:
+            with self.assertRaises(OAGraphStorageError):
+                pool.getconn()
+        finally:
+            pool._timeout = timeout
+            for conn in conns:
+                pool.putconn(conn)
+        self.assertEqual(pool.idle, pool.size)
+
+    def test_prepared_statements(self):
+        """Repeated prepared executions reuse one server side statement"""
+        with OADao("test", trans_commit_hold=True) as dao:
+            for i in range(3):
+                ret = dao.execute(self.SQL.get_prepared_sample, [i], prepare=True)
+                self.assertEqual(ret[0]['prepared_test_val'], i)
+            ret = dao.execute(self.SQL.get_prepared_statements)
+            self.assertEqual(len(ret), 1)
+
+            # Named parameters and quoted literals run as plain statements
+            ret = dao.execute(self.SQL.get_prepared_sample_named, {'val' : 5}, prepare=True)
+            self.assertEqual(ret[0]['prepared_test_val'], 5)
+            ret = dao.execute(self.SQL.get_prepared_sample_literal, [6], prepare=True)
+            self.assertEqual((ret[0]['prepared_test_val'], ret[0]['prepared_test_pct']), (6, '100%'))
+            ret = dao.execute(self.SQL.get_prepared_statements)
+            self.assertEqual(len(ret), 1)
+
     def test_nested_transactions(self):
         with OADbTransaction("Level 1") as trans1:
             self.assertEqual(trans1.dao.trans_depth, 2)
@@ -109,3 +181,11 @@ class TestOADao(unittest.TestCase, TestOABase):
             "INSERT INTO test.sample_table( field2 ) VALUES ( %s )"
         get_rows_from_sample_table =\
             "SELECT field2 FROM test.sample_table"
+        get_prepared_sample =\
+            "SELECT %s::int AS prepared_test_val"
+        get_prepared_sample_named =\
+            "SELECT %(val)s::int AS prepared_test_val"
+        get_prepared_sample_literal =\
+            "SELECT %s::int AS prepared_test_val, '100%%'::text AS prepared_test_pct"
+        get_prepared_statements =\
+            "SELECT name FROM pg_prepared_statements WHERE position('prepared_test_val' in statement)>0"
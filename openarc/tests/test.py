@@ -8,7 +8,7 @@ class TestOABase(object):
         from openarc._env import oaenv, oainit
 
         oainit()
-        self.dbconn = psycopg2.connect(**{k:v for k, v in oaenv.dbinfo.items() if k!='on_demand_schema'})
+        self.dbconn = psycopg2.connect(**{k:v for k, v in oaenv.dbinfo.items() if k in self.dbconnprms})
         with self.dbconn.cursor() as cur:
             cur.execute(self.SQL.drop_test_schema)
             cur.execute(self.SQL.create_test_schema)
@@ -27,6 +27,8 @@ class TestOABase(object):
         with self.dbconn.cursor() as setupcur:
             setupcur.execute(self.SQL.delete_openarc_rpc)
 
+    dbconnprms = ['dbname', 'host', 'password', 'port', 'user']
+
     class SQL(object):
         ## Test schema helper SQL
         drop_test_schema =\
@@ -11,17 +11,13 @@ from ._env import oalog
 class OATime(object):
     """Executes time queries on database, returning
     consistent time view to caller"""
-    def __init__(self, dt=None, extcur=None):
-        self.cur = extcur
+    def __init__(self, dt=None):
         self.dt  = dt
 
     @property
     def now(self):
-        if self.cur is None:
-            from ._dao import OADao
-            self.cur = OADao("openarc").cur
-        self.cur.execute(self.SQL.get_current_time)
-        return self.cur.fetchall()[0]['timezone']
+        from ._dao import OADao
+        return OADao("openarc").execute(self.SQL.get_current_time)[0]['timezone']
 
     def to_unixtime(self):
         ms = (self.dt.microsecond/1000000.0)
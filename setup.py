@@ -25,5 +25,8 @@ setup(name='openarc',
           'toml',
           'zmq'
       ],
+      extras_require={
+          'columnar': ['numpy'],
+      },
       include_package_data=True,
       zip_safe=False)